@@ -0,0 +1,209 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Headless batch runner for many MCCs. All accounts of all MCCs go through one
+# worker pool, largest first, so throughput scales with the total number of
+# accounts rather than the number of MCCs. Every Google Ads API request of the
+# batch waits for one shared rate limiter.
+#
+# Usage: python batch.py batch.yaml
+#
+# batch.yaml:
+#   max_workers: 16
+#   requests_per_second: 20  # Google Ads API requests of the whole batch
+#   metrics_port: 9090        # Optional, serves Prometheus metrics on localhost
+#   channels_per_service: 4   # Optional, gRPC channels per Ads service and MCC
+#   keepalive_ms: 30000       # Optional, gRPC keep-alive interval, 0 disables
+#   runs:
+#     - client_id: ...
+#       client_secret: ...
+#       refresh_token: ...
+#       developer_token: ...
+#       login_customer_id: ...
+#       spreadsheet_url: ...   # Required, the MCC's results spreadsheet
+#       dry_run_negatives: true  # Optional, validates the planned negative keywords
+#       settings:
+#         start_date: 2023-01-01
+#         end_date: 2023-01-31
+#         clicks: 10
+#         quota_budget: 5000   # Optional, API operations this MCC may use
+#         quota_mode: hard     # Optional, soft (default) or hard
+
+import sys
+import time
+import logging
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+from main import process_account, get_account_size, score_account, split_results, write_results, add_keyword_shard
+from utils.ads_searcher import AccountsBuilder
+from utils.entities import RunSettings
+from utils.keyword_index import KeywordIndex
+from utils.quota import OperationAccountant, QuotaBudgetExceeded
+from utils.rate_limiter import RateLimiter
+from utils.service_pool import pool
+from utils import metrics
+from utils.sheets import SheetsInteractor, get_sheets_service
+
+_DEFAULT_MAX_WORKERS = 16
+_DEFAULT_REQUESTS_PER_SECOND = 20
+
+
+class BatchRun:
+    """A single MCC in the batch, with its own client, settings and destination spreadsheet.
+    A failure of one MCC marks it as failed, the other MCCs of the batch go on."""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.mcc_id = str(config['login_customer_id'])
+        if not config.get('spreadsheet_url'):
+            # A spreadsheet created per scheduled run would be a new orphan file every day
+            raise ValueError(f'No spreadsheet_url for MCC {self.mcc_id} in the batch config.')
+        self.run_settings = RunSettings.from_dict(config['settings'])
+        self.client = pool.get_client({
+            'client_id': config['client_id'],
+            'client_secret': config['client_secret'],
+            'login_customer_id': self.mcc_id,
+            'developer_token': config['developer_token'],
+            'refresh_token': config['refresh_token'],
+            'use_proto_plus': True,
+        })
+        self.keyword_index = KeywordIndex() if self.run_settings.mcc_wide_dedup else None
+        self.accountant = OperationAccountant(self.run_settings.quota_budget, self.run_settings.quota_mode)
+        self.results = []
+        self.failed = False
+
+    def get_sheets_handler(self) -> SheetsInteractor:
+        return SheetsInteractor(get_sheets_service(self.config), self.config['spreadsheet_url'])
+
+    def fail(self, stage: str, e: Exception):
+        logging.exception(f'{stage} of MCC {self.mcc_id} failed, skipping the MCC: {e}')
+        self.failed = True
+
+
+def _create_runs(configs: List[Dict[str, Any]]) -> List[BatchRun]:
+    runs = []
+    for config in configs:
+        try:
+            runs.append(BatchRun(config))
+        except Exception as e:
+            logging.exception(f"Setting up MCC {config.get('login_customer_id')} failed, skipping the MCC: {e}")
+    return runs
+
+
+def run_batch(batch_config: Dict[str, Any]) -> List[BatchRun]:
+    if batch_config.get('metrics_port'):
+        metrics.start_exporter(batch_config['metrics_port'])
+    else:
+        metrics.start_exporter_from_env()
+    pool.configure(channels_per_service=batch_config.get('channels_per_service'),
+                   keepalive_ms=batch_config.get('keepalive_ms'))
+    start = time.perf_counter()
+    runs = _create_runs(batch_config['runs'])
+    limiter = RateLimiter(batch_config.get('requests_per_second', _DEFAULT_REQUESTS_PER_SECOND))
+
+    with ThreadPoolExecutor(max_workers=batch_config.get('max_workers', _DEFAULT_MAX_WORKERS)) as executor:
+        # Resolve accounts of MCCs that run on all of their accounts
+        account_futures = [(run, executor.submit(AccountsBuilder(run.client, run.accountant, limiter).get_accounts))
+                           for run in runs if not run.run_settings.accounts]
+        for run, future in account_futures:
+            try:
+                run.run_settings.accounts = future.result()
+            except Exception as e:
+                run.fail('Listing accounts', e)
+
+        # List the accounts under MCCs that build an MCC-wide keyword index
+        mcc_accounts_futures = [(run, executor.submit(AccountsBuilder(run.client, run.accountant, limiter).get_accounts))
+                                for run in runs if run.keyword_index is not None and not run.failed]
+        mcc_accounts = []
+        for run, future in mcc_accounts_futures:
+            try:
+                mcc_accounts.append((run, future.result()))
+            except Exception as e:
+                run.fail('Listing accounts for the keyword index', e)
+
+        # Score every account of every MCC and schedule them largest first
+        size_futures = [(run, account, executor.submit(get_account_size, run.client, run.run_settings,
+                                                       account, run.accountant, limiter))
+                        for run in runs if not run.failed for account in run.run_settings.accounts]
+        scheduled = []
+        for run, account, future in size_futures:
+            try:
+                size = future.result()
+            except QuotaBudgetExceeded as e:
+                logging.warning(f'Skipping account {account} of MCC {run.mcc_id}: {e}')
+                continue
+            except Exception as e:
+                logging.exception(f'Sizing account {account} of MCC {run.mcc_id} failed, skipping the account: {e}')
+                continue
+            score = score_account(run.run_settings, account, size)
+            if score is not None:
+                scheduled.append((score, run, account, size))
+        scheduled.sort(key=lambda item: item[0], reverse=True)
+        logging.info(f'Batch of {len(runs)} MCCs scheduled {len(scheduled)} of {len(size_futures)} accounts')
+
+        index_accounts = {run: len(accounts) for run, accounts in mcc_accounts}
+        for run in runs:
+            if run.failed:
+                continue
+            run_sizes = [size for _, scheduled_run, _, size in scheduled if scheduled_run is run]
+            run.accountant.estimate_run(len(run_sizes), index_accounts.get(run, 0),
+                                        sum(run.run_settings.max_search_term_rows(size) for size in run_sizes),
+                                        int(run.config.get('dry_run_negatives', False)))
+
+        # Build MCC-wide keyword indexes, one shard per account under the MCC
+        shard_futures = [(run, executor.submit(add_keyword_shard, run.client, run.keyword_index,
+                                               account, run.accountant, limiter))
+                         for run, accounts in mcc_accounts for account in accounts]
+        for run, future in shard_futures:
+            try:
+                future.result()
+            except QuotaBudgetExceeded as e:
+                logging.warning(f'Keyword index of MCC {run.mcc_id} is incomplete: {e}')
+            except Exception as e:
+                if not run.failed:
+                    run.fail('Building the keyword index', e)
+        for run, _ in mcc_accounts:
+            run.keyword_index.freeze()
+
+        futures = [(run, account, executor.submit(process_account,
+                                                  run.client, run.run_settings, account, run.keyword_index,
+                                                  run.accountant, run.config.get('dry_run_negatives', False),
+                                                  limiter))
+                   for _, run, account, _ in scheduled if not run.failed]
+        for run, account, future in futures:
+            try:
+                run.results.append((account, future.result()))
+            except Exception as e:
+                logging.exception(f'Account {account} of MCC {run.mcc_id} failed: {e}')
+
+    for run in runs:
+        if run.failed:
+            continue
+        try:
+            write_results(run.client, run.get_sheets_handler(), split_results(run.results), run.run_settings,
+                          dry_run_negatives=run.config.get('dry_run_negatives', False),
+                          accountant=run.accountant, limiter=limiter)
+            logging.info(f'Batch run for MCC {run.mcc_id} completed')
+        except Exception as e:
+            logging.exception(f'Writing results of MCC {run.mcc_id} failed: {e}')
+
+    # MCCs share one worker pool, so only the whole batch has a meaningful duration
+    metrics.RUN_SECONDS.observe(time.perf_counter() - start, kind='batch')
+    return runs
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'r') as f:
+        run_batch(yaml.load(f, Loader=yaml.SafeLoader))
@@ -0,0 +1,73 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures n-gram mining throughput over synthetic search_term_view rows.
+#
+# Usage: python benchmarks/ngrams.py [--rows 1000000] [--min-rows-per-second 150000]
+# Exits with 1 when throughput is below the target.
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from utils.ngrams import mine_ngrams
+
+_VOCABULARY_SIZE = 5000
+_AD_GROUPS_PER_TERM = 3
+
+
+def synthetic_search_terms(rows: int, seed: int = 0):
+    """Builds a SearchTermBuilder shaped dict with about `rows` search term and ad group rows."""
+    rng = random.Random(seed)
+    vocabulary = [f'word{i}' for i in range(_VOCABULARY_SIZE)]
+    search_terms = {}
+    count = 0
+    while count < rows:
+        term = ' '.join(rng.choices(vocabulary, k=rng.randint(1, 6)))
+        ad_groups = search_terms.setdefault(term, {})
+        for _ in range(rng.randint(1, _AD_GROUPS_PER_TERM)):
+            count += 1
+            ad_groups[rng.randint(1, 10000)] = {
+                'clicks': rng.randint(0, 50),
+                'impressions': rng.randint(1, 1000),
+                'cost': rng.random() * 20,
+                'conversions': rng.choice([0, 0, 0, 1, 2]),
+            }
+    return search_terms
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Measures n-gram mining throughput.')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--min-rows-per-second', type=float, default=150000)
+    args = parser.parse_args(argv)
+
+    search_terms = synthetic_search_terms(args.rows)
+    rows = sum(len(v) for v in search_terms.values())
+
+    start = time.perf_counter()
+    result = mine_ngrams(search_terms)
+    elapsed = time.perf_counter() - start
+
+    throughput = rows / elapsed
+    print(f'{rows} rows, {len(search_terms)} search terms, {len(result)} ranked n-grams')
+    print(f'{elapsed:.2f}s, {throughput:,.0f} rows/s (target {args.min_rows_per_second:,.0f} rows/s)')
+    return 0 if throughput >= args.min_rows_per_second else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
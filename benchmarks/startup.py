@@ -0,0 +1,94 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures cold start time in fresh interpreters, the part of time-to-first-page
+# on a scale-from-zero container that the code controls: frontend.py's imports and
+# the Config() of the first render, with the bucket read stubbed out.
+#
+# Usage: python benchmarks/startup.py [--runs 5] [--max-seconds 1.5]
+# Exits with 1 when the first page exceeds the budget.
+
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+_REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Cloud Storage client whose config.yaml is empty, so the network read is left out
+_STUB_STORAGE = """
+import io
+from google.cloud import storage
+
+class _StubBlob:
+    def open(self, mode='r'):
+        return io.StringIO('')
+
+class _StubClient:
+    def bucket(self, name):
+        return self
+
+    def blob(self, name):
+        return _StubBlob()
+
+storage.Client = _StubClient
+"""
+
+
+def first_page_statement() -> str:
+    """frontend.py's top-level imports, then the Config() initialize_session_state creates."""
+    source = (_REPO_ROOT / 'frontend.py').read_text()
+    imports = [ast.get_source_segment(source, node) for node in ast.parse(source).body
+               if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return '\n'.join([_STUB_STORAGE] + imports + ['Config()'])
+
+
+# Deferred until the first run or account listing
+FIRST_RUN = 'import main'
+
+
+def measure(statement: str, runs: int) -> float:
+    """Returns the median wall time of running `statement` in a new interpreter."""
+    env = dict(os.environ, bucket_name=os.getenv('bucket_name', 'benchmark'))
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=_REPO_ROOT, env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Measures cold start import time.')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=1.5,
+                        help='Budget for the first page')
+    args = parser.parse_args(argv)
+
+    baseline = measure('pass', args.runs)
+    first_page = measure(first_page_statement(), args.runs) - baseline
+    first_run = measure(FIRST_RUN, args.runs) - baseline
+
+    print(f'interpreter start:   {baseline:.3f}s')
+    print(f'first page:          {first_page:.3f}s (budget {args.max_seconds:.3f}s)')
+    print(f'first run imports:   {first_run:.3f}s')
+    return 0 if first_page <= args.max_seconds else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -14,9 +14,10 @@
 
 import streamlit as st
 from utils.config import Config
-import utils.auth as auth
+from utils.ranking import RANK_METRICS, RANK_GROUPS
+from utils.quota import QUOTA_MODES
+from utils.metrics import start_exporter_from_env
 from time import sleep
-from main import run_from_ui, get_accounts_for_ui
 from datetime import datetime
 
 OAUTH_HELP = """Refer to
@@ -60,6 +61,8 @@ def update_btn_state():
     st.session_state.run_btn_clicked = True 
 
 def get_accounts_list():
+    # main pulls in the Ads and Sheets client libraries, import it only when needed
+    from main import get_accounts_for_ui
     st.session_state.accounts_for_ui = get_accounts_for_ui(st.session_state.config)
 
 def value_placeholder(value):
@@ -67,6 +70,7 @@ def value_placeholder(value):
     else: return ''
 
 def run_tool():
+    from main import run_from_ui
     parameters = {
             'start_date': str(st.session_state.start_date),
             'end_date': str(st.session_state.end_date),
@@ -75,12 +79,28 @@ def run_tool():
             'ctr': st.session_state.ctr,
             'cost': st.session_state.cost,
             'conversions': st.session_state.conversions,
-            'accounts': st.session_state.accounts_selected
+            'accounts': st.session_state.accounts_selected,
+            'mcc_wide_dedup': st.session_state.mcc_wide_dedup,
+            'ngram_analysis': st.session_state.ngram_analysis,
+            'delta_writes': st.session_state.delta_writes,
+            'top_k': st.session_state.top_k,
+            'rank_metric': st.session_state.rank_metric,
+            'rank_by': st.session_state.rank_by,
+            'quota_budget': st.session_state.quota_budget,
+            'quota_mode': st.session_state.quota_mode,
+            'dry_run_negatives': st.session_state.dry_run_negatives,
+            'profile': st.session_state.profile
         }
 
-    run_from_ui(parameters, st.session_state.config)
+    report_path = run_from_ui(parameters, st.session_state.config)
     results_url = config.spreadsheet_url
     st.success(f'Search term analysis completed successfully. [Open in Google Sheets]({results_url})', icon="✅")
+    if report_path:
+        with open(report_path) as f:
+            st.download_button("Download profile report", f.read(), file_name=report_path.name)
+
+# Only the first rerun in the process starts the exporter, when metrics_port is set
+start_exporter_from_env()
 
 # The Page UI starts here
 st.set_page_config(
@@ -153,6 +173,23 @@ with st.expander("**Run Settings**", expanded=st.session_state.valid_config and
     cost.number_input("Cost", min_value=0, key="cost")
     conversions.number_input("Conversions", min_value=0, key="conversions")
 
+    st.checkbox("Skip new keywords that already exist in other accounts under the MCC", key="mcc_wide_dedup")
+    # Output size limits
+    top_k, rank_metric, rank_by = st.columns(3)
+    top_k.number_input("Top rows (0 keeps all)", min_value=0, key="top_k")
+    rank_metric.selectbox("Rank by metric", RANK_METRICS, key="rank_metric")
+    rank_by.selectbox("Per", RANK_GROUPS, key="rank_by")
+    # API operations budget
+    quota_budget, quota_mode = st.columns(2)
+    quota_budget.number_input("API operations budget (0 is unlimited)", min_value=0, key="quota_budget")
+    quota_mode.selectbox("When the budget is reached", QUOTA_MODES, key="quota_mode",
+                         format_func=lambda mode: {'soft': 'Warn and continue', 'hard': 'Stop'}[mode])
+
+    st.checkbox("Find wasteful n-grams across search terms", key="ngram_analysis")
+    st.checkbox("Only write rows that changed since the previous run", key="delta_writes")
+    st.checkbox("Validate negative keyword upload (dry run, nothing is applied)", key="dry_run_negatives")
+    st.checkbox("Profile this run (CPU and memory report)", key="profile")
+
 st.session_state.run_btn_clicked = st.button("**Run**",type='primary', disabled=not st.session_state.valid_config, on_click=update_btn_state)
 
 if st.session_state.run_btn_clicked:
@@ -12,24 +12,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import annotations
+
 import sys
 import logging
-import utils.auth as auth
+import argparse
 from pathlib import Path
-from pprint import pprint
-from utils.auth import CONFIG_FILE, SCOPES
-from utils.sheets import SheetsInteractor, get_sheets_service, create_new_spreadsheet, flatten_data
-from utils.ads_searcher import AccountsBuilder, SearchTermBuilder, KeywordDedupingBuilder
+from utils.sheets import SheetsInteractor, get_sheets_service, create_new_spreadsheet, flatten_data, recommendation_rows, flatten_dry_run, flatten_ngrams, flatten_quota_usage, flatten_rollups
+from utils.ads_searcher import AccountsBuilder, AccountKeywordsBuilder, AccountSizeBuilder, SearchTermBuilder, KeywordDedupingBuilder
+from utils.keyword_index import KeywordIndex
+from utils.ngrams import mine_ngrams
+from utils.rollups import summarize
 from utils.ads_mutator import NegativeKeywordsUploader
 from utils.entities import RunSettings
 from utils.config import Config
-from typing import Dict, Any, Optional, Union
-from google.ads.googleads.client import GoogleAdsClient
-from google.ads.googleads.errors import GoogleAdsException
+from utils.profiler import RunProfiler, PROFILE_REPORT_PATH
+from utils.run_cache import RunCache, run_key
+from utils.ranking import TopKRanker, RANK_METRICS, RANK_GROUPS
+from utils.rate_limiter import RateLimiter
+from utils.quota import OperationAccountant, QuotaBudgetExceeded, QUOTA_MODES
+from utils import metrics
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+
+if TYPE_CHECKING:
+    from google.ads.googleads.client import GoogleAdsClient
 
 _LOGS_PATH = Path('./script.log')
 _KEYWORDS_SHEET = 'Keywords'
 _EXCLUSIONS_SHEET = 'Exclusions'
+_DRY_RUN_SHEET = 'Dry Run'
+_NGRAMS_SHEET = 'N-gram negatives'
+_QUOTA_SHEET = 'Quota Usage'
+_SUMMARY_SHEETS = {'account': 'Account Summary', 'campaign': 'Campaign Summary', 'ad_group': 'Ad Group Summary'}
+_MAX_WORKERS = 8
+
+# Shared by every session of the deployment, so identical runs are only fetched once.
+_RUN_CACHE = RunCache()
 
 logging.basicConfig(filename=_LOGS_PATH,
                     level=logging.INFO,
@@ -37,29 +56,188 @@ logging.basicConfig(filename=_LOGS_PATH,
 
 
 
-def _get_search_terms(client: GoogleAdsClient, run_settings: RunSettings, account: str) -> Dict[str, Dict[str, Any]]:
+def _get_search_terms(client: GoogleAdsClient, run_settings: RunSettings, account: str,
+                      accountant: Optional[OperationAccountant] = None,
+                      filter_conversions: bool = True,
+                      limiter: Optional[RateLimiter] = None) -> Dict[str, Dict[str, Any]]:
     """Uses the SearchTermBuilder class to get all Search Terms from A specific account"""
-    builder = SearchTermBuilder(client, account)
-    return builder.build(run_settings.thresholds, run_settings.start_date, run_settings.end_date)
+    builder = SearchTermBuilder(client, account, accountant, limiter)
+    return builder.build(run_settings.thresholds, run_settings.start_date, run_settings.end_date,
+                         filter_conversions)
 
 
-def _dedup_and_get_exclusions(client: GoogleAdsClient, run_settings: RunSettings, account: str, search_terms: Dict[str, Any]):
+def _dedup_and_get_exclusions(client: GoogleAdsClient, run_settings: RunSettings, account: str, search_terms: Dict[str, Any],
+                              keyword_index: Optional[KeywordIndex] = None,
+                              accountant: Optional[OperationAccountant] = None,
+                              limiter: Optional[RateLimiter] = None):
     """Removes existing keywords froms search term dict and return an exclusion list"""
-    kw_builder = KeywordDedupingBuilder(client, account)
-    return kw_builder.build(search_terms)
+    kw_builder = KeywordDedupingBuilder(client, account, accountant, limiter)
+    return kw_builder.build(search_terms, keyword_index)
+
+
+def process_account(client: GoogleAdsClient, run_settings: RunSettings, account: str,
+                    keyword_index: Optional[KeywordIndex] = None,
+                    accountant: Optional[OperationAccountant] = None,
+                    keep_negatives: bool = False,
+                    limiter: Optional[RateLimiter] = None) -> Dict[str, Any]:
+    """Gets search terms of a single account and splits them into keyword and exclusion recommendations,
+    with their rollup summaries and n-gram negative candidates when enabled.
+
+    Recommendations are laid out as sheet rows right away, only the top K per group when set, so the
+    run holds at most one account's full search terms at a time. The full exclusions are also returned
+    as negatives with keep_negatives, to upload or validate them. Every API request waits for
+    the limiter, when given."""
+    with metrics.IN_FLIGHT_ACCOUNTS.track():
+        ngrams = []
+        if run_settings.ngram_analysis:
+            # N-grams also need the non converting search terms, the most wasteful ones,
+            # so they are streamed without the conversions threshold and mined before it's applied
+            search_terms = _get_search_terms(client, run_settings, account, accountant, filter_conversions=False,
+                                             limiter=limiter)
+            ngrams = mine_ngrams(search_terms)
+            SearchTermBuilder.only_converting(search_terms, run_settings.thresholds)
+        else:
+            search_terms = _get_search_terms(client, run_settings, account, accountant, limiter=limiter)
+        exclusions = _dedup_and_get_exclusions(
+            client, run_settings, account, search_terms, keyword_index, accountant, limiter)
+        result = {'keywords': recommendation_rows(search_terms, _get_ranker(run_settings)),
+                  'exclusions': recommendation_rows(exclusions, _get_ranker(run_settings)),
+                  'ngrams': ngrams,
+                  'rollups': summarize(search_terms, exclusions)}
+        if keep_negatives:
+            result['negatives'] = exclusions
+    return result
+
+
+def add_keyword_shard(client: GoogleAdsClient, keyword_index: KeywordIndex, account: str,
+                      accountant: Optional[OperationAccountant] = None,
+                      limiter: Optional[RateLimiter] = None):
+    """Uses the AccountKeywordsBuilder class to add the keywords of a specific account to the MCC-wide index"""
+    keyword_index.add_shard(account, AccountKeywordsBuilder(client, account, accountant, limiter).build())
+
+
+def build_keyword_index(client: GoogleAdsClient, executor: ThreadPoolExecutor,
+                        accountant: Optional[OperationAccountant] = None,
+                        accounts: Optional[List[str]] = None) -> KeywordIndex:
+    """Builds the MCC-wide keyword index over all accounts under the MCC, one shard per account.
+    Lists the accounts unless they are given"""
+    keyword_index = KeywordIndex()
+    if accounts is None:
+        accounts = AccountsBuilder(client, accountant).get_accounts()
+    for _ in executor.map(lambda account: add_keyword_shard(client, keyword_index, account, accountant),
+                          accounts):
+        pass
+    keyword_index.freeze()
+    logging.info(f'MCC-wide keyword index holds {len(keyword_index)} keywords')
+    return keyword_index
+
+
+def get_account_size(client: GoogleAdsClient, run_settings: RunSettings, account: str,
+                     accountant: Optional[OperationAccountant] = None,
+                     limiter: Optional[RateLimiter] = None) -> Dict[str, float]:
+    """Uses the AccountSizeBuilder class to get the search traffic totals of a specific account"""
+    builder = AccountSizeBuilder(client, account, accountant, limiter)
+    return builder.build(run_settings.start_date, run_settings.end_date)
+
+
+def score_account(run_settings: RunSettings, account: str, size: Dict[str, float]) -> Optional[Tuple[float, float]]:
+    """Returns the scheduling score of an account, or None if it can't have qualifying search terms.
+    Accounts are ranked by their most possible search term rows, which doesn't depend on the
+    account's currency. Cost only breaks ties."""
+    if not run_settings.has_qualifying_traffic(size):
+        logging.info(f'Skipping account {account}, no qualifying traffic: {size}')
+        return None
+    return run_settings.max_search_term_rows(size), size['cost_micros']
+
+
+def _schedule_accounts(client: GoogleAdsClient, run_settings: RunSettings, executor: ThreadPoolExecutor,
+                       accountant: Optional[OperationAccountant] = None) -> List[Tuple[str, Dict[str, float]]]:
+    """Scores accounts by their search traffic, drops accounts that can't have qualifying
+    search terms and orders the rest largest first, so big accounts don't start last.
+    Returns (account, size) pairs."""
+    sizes = executor.map(
+        lambda account: get_account_size(client, run_settings, account, accountant),
+        run_settings.accounts)
+
+    scored = []
+    for account, size in zip(run_settings.accounts, sizes):
+        score = score_account(run_settings, account, size)
+        if score is not None:
+            scored.append((score, account, size))
 
+    scored.sort(key=lambda item: item[:2], reverse=True)
+    return [(account, size) for _, account, size in scored]
 
-def _add_negative_keywords(client, account, neg_kw):
-    builder = NegativeKeywordsUploader(client, account)
+
+def split_results(results: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Turns (account, process_account result) pairs into recommendations of each kind keyed by account"""
+    recommendations = {'keywords': {}, 'exclusions': {}, 'negatives': {}, 'ngrams': {}, 'rollups': {}}
+    for account, result in results:
+        for kind, values in result.items():
+            if values:
+                recommendations[kind][account] = values
+    return recommendations
+
+
+def _collect_recommendations(client: GoogleAdsClient, run_settings: RunSettings, profiler: RunProfiler,
+                             accountant: Optional[OperationAccountant] = None,
+                             mutate_passes: int = 0) -> Dict[str, Dict[str, Any]]:
+    """Returns recommendations of all accounts, see split_results. The full exclusions are kept
+    for mutate_passes, the number of upload and dry run passes. In hard quota mode, accounts
+    reached after the budget is used up are left out."""
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        mcc_accounts = None
+        if run_settings.mcc_wide_dedup:
+            with profiler.phase('keyword_index'):
+                mcc_accounts = AccountsBuilder(client, accountant).get_accounts()
+        with profiler.phase('schedule'):
+            scheduled = _schedule_accounts(client, run_settings, executor, accountant)
+        if accountant:
+            accountant.estimate_run(len(scheduled), len(mcc_accounts or []),
+                                    sum(run_settings.max_search_term_rows(size) for _, size in scheduled),
+                                    mutate_passes)
+        keyword_index = None
+        if run_settings.mcc_wide_dedup:
+            with profiler.phase('keyword_index'):
+                keyword_index = build_keyword_index(client, executor, accountant, mcc_accounts)
+        with profiler.phase('collect'):
+            futures = [(account, executor.submit(process_account, client, run_settings, account,
+                                                 keyword_index, accountant, mutate_passes > 0))
+                       for account, _ in scheduled]
+            results = []
+            for account, future in futures:
+                try:
+                    results.append((account, future.result()))
+                except QuotaBudgetExceeded as e:
+                    logging.warning(f'Skipping account {account}: {e}')
+
+    return split_results(results)
+
+
+def _get_ranker(run_settings: RunSettings) -> Optional[TopKRanker]:
+    """Returns a new top K ranker for one account's keywords or exclusions, or None when all rows are kept"""
+    if not run_settings.top_k:
+        return None
+    return TopKRanker(run_settings.top_k, run_settings.rank_metric, run_settings.rank_by)
+
+
+def _add_negative_keywords(client, account, neg_kw, accountant=None, limiter=None):
+    builder = NegativeKeywordsUploader(client, account, accountant, limiter)
     builder.upload_from_script(neg_kw)
 
 
+def _validate_negative_keywords(client, account, neg_kw, accountant=None, limiter=None):
+    builder = NegativeKeywordsUploader(client, account, accountant, limiter)
+    return builder.validate_from_script(neg_kw)
+
+
 def upload_from_sheets(client, sheet_handler):
     pass
 
 
 def run_from_ui(params: Dict[str, str], config: Config):
     # Temp function to trigger the run from UI. For when we want to keep both running options
+    # Returns the path of the profile report when params['profile'] is set.
     sheets_service = get_sheets_service(config.__dict__)
     if not config.spreadsheet_url:
         config.spreadsheet_url = create_new_spreadsheet(sheets_service)
@@ -67,8 +245,12 @@ def run_from_ui(params: Dict[str, str], config: Config):
     sheets_handler = SheetsInteractor(sheets_service, config.spreadsheet_url)
     google_ads_client = config.get_ads_client()
 
-    main(google_ads_client, config.login_customer_id,
-         sheets_handler, params, auto_upload_negatives=False)
+    with RunProfiler(enabled=params.get('profile', False)) as profiler:
+        main(google_ads_client, config.login_customer_id,
+             sheets_handler, params, auto_upload_negatives=False,
+             dry_run_negatives=params.get('dry_run_negatives', False),
+             profiler=profiler)
+    return profiler.save_report()
 
 
 def get_accounts_for_ui(config: Config):
@@ -80,41 +262,118 @@ def main(client: GoogleAdsClient,
          mcc_id: str,
          sheet_handler: SheetsInteractor,
          params: Dict[Any, Any] = None,
-         auto_upload_negatives: bool = False):
-
+         auto_upload_negatives: bool = False,
+         dry_run_negatives: bool = False,
+         profiler: Optional[RunProfiler] = None):
 
+    profiler = profiler or RunProfiler()
     run_settings = RunSettings.from_dict(params)
+    accountant = OperationAccountant(run_settings.quota_budget, run_settings.quota_mode)
 
-    if not run_settings.accounts:
-        run_settings.accounts = AccountsBuilder(client).get_accounts()
+    with metrics.RUN_SECONDS.time(kind='single'):
+        logging.info(run_settings)
+        try:
+            if not run_settings.accounts:
+                with profiler.phase('accounts'):
+                    run_settings.accounts = AccountsBuilder(client, accountant).get_accounts()
 
-    logging.info(run_settings)
+            mutate_passes = int(auto_upload_negatives) + int(dry_run_negatives)
+            collect = lambda: _collect_recommendations(client, run_settings, profiler, accountant, mutate_passes)
+            if profiler.enabled:
+                # A profiled run has to do the work it reports on, not serve a cached result
+                recommendations = collect()
+            else:
+                recommendations = _RUN_CACHE.get_or_run(run_key(mcc_id, run_settings, mutate_passes > 0), collect)
+        except QuotaBudgetExceeded as e:
+            # Stopped before any account was processed, still record what the run used
+            logging.error(e)
+            sheet_handler.write_to_spreadsheet({_QUOTA_SHEET: flatten_quota_usage(accountant)})
+            raise
+
+        write_results(client, sheet_handler, recommendations, run_settings,
+                      auto_upload_negatives, dry_run_negatives, profiler, accountant)
 
-    keyword_recommendations = {}
-    exclusion_recommendations = {}
-    for account in run_settings.accounts:
-        search_terms = _get_search_terms(client, run_settings, account)
-        exclusions = _dedup_and_get_exclusions(
-            client, run_settings, account, search_terms)
-        if search_terms:
-            keyword_recommendations[account] = search_terms
-        if exclusions:
-            exclusion_recommendations[account] = exclusions
 
-    # pprint(keyword_recommendations)
-    # pprint(exclusion_recommendations)
+def write_results(client: GoogleAdsClient,
+                  sheet_handler: SheetsInteractor,
+                  recommendations: Dict[str, Dict[str, Any]],
+                  run_settings: RunSettings,
+                  auto_upload_negatives: bool = False,
+                  dry_run_negatives: bool = False,
+                  profiler: Optional[RunProfiler] = None,
+                  accountant: Optional[OperationAccountant] = None,
+                  limiter: Optional[RateLimiter] = None):
+    """Uploads or validates negatives if requested and writes recommendations to the spreadsheet,
+    with the run's API operation usage when an accountant is given"""
+    profiler = profiler or RunProfiler()
+    negatives = recommendations['negatives']
 
     # If auto upload, iterate over exclusion dict and for each account add negative kws
     if auto_upload_negatives:
-        for account, neg_kw in exclusion_recommendations.items():
-            _add_negative_keywords(client, account, neg_kw)
+        with profiler.phase('upload'):
+            for account, neg_kw in negatives.items():
+                _add_negative_keywords(client, account, neg_kw, accountant, limiter)
+
+    output = {}
+    # Dry run validates the planned negatives without applying them
+    if dry_run_negatives:
+        with profiler.phase('dry_run'):
+            dry_run_reports = [_validate_negative_keywords(client, account, neg_kw, accountant, limiter)
+                               for account, neg_kw in negatives.items()]
+            output[_DRY_RUN_SHEET] = flatten_dry_run(dry_run_reports)
+
+    with profiler.phase('flatten'):
+        output[_KEYWORDS_SHEET] = flatten_data(recommendations['keywords'])
+        output[_EXCLUSIONS_SHEET] = flatten_data(recommendations['exclusions'])
+    # Summaries cover all recommendations, also rows cut by top K
+    for level, sheet in _SUMMARY_SHEETS.items():
+        output[sheet] = flatten_rollups(recommendations['rollups'], level)
+    if recommendations['ngrams']:
+        output[_NGRAMS_SHEET] = flatten_ngrams(recommendations['ngrams'])
+    if accountant:
+        output[_QUOTA_SHEET] = flatten_quota_usage(accountant)
+    with profiler.phase('write'):
+        sheet_handler.write_to_spreadsheet(output, delta=run_settings.delta_writes)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Runs SeaTerA headless with the configuration stored in the bucket.')
+    parser.add_argument('--start_date', required=True)
+    parser.add_argument('--end_date', required=True)
+    parser.add_argument('--clicks', type=int, default=0)
+    parser.add_argument('--impressions', type=int, default=0)
+    parser.add_argument('--ctr', type=float, default=0)
+    parser.add_argument('--cost', type=int, default=0)
+    parser.add_argument('--conversions', type=float, default=0)
+    parser.add_argument('--accounts', default='',
+                        help='Comma separated account IDs. Runs on all accounts when empty.')
+    parser.add_argument('--mcc_wide_dedup', action='store_true',
+                        help='Drop new keywords that already exist in other accounts of the MCC')
+    parser.add_argument('--ngram_analysis', action='store_true',
+                        help='Write wasteful n-grams across search terms to a separate sheet')
+    parser.add_argument('--delta_writes', action='store_true',
+                        help='Only write rows that changed since the previous run')
+    parser.add_argument('--top_k', type=int, default=0,
+                        help='Keep only the top K rows per account or campaign, 0 keeps all')
+    parser.add_argument('--rank_metric', choices=RANK_METRICS, default='cost')
+    parser.add_argument('--rank_by', choices=RANK_GROUPS, default='account')
+    parser.add_argument('--quota_budget', type=int, default=0,
+                        help='Google Ads API operations the run may use, 0 is unlimited')
+    parser.add_argument('--quota_mode', choices=QUOTA_MODES, default='soft',
+                        help='soft warns once the budget is exceeded, hard stops before exceeding it')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'Profile the run and save a report to {PROFILE_REPORT_PATH}')
+    args = parser.parse_args(argv)
+    params = vars(args)
+    params['accounts'] = [a for a in args.accounts.split(',') if a]
+    return params
 
-    flattened_kw_recommendations = flatten_data(keyword_recommendations)
-    flattened_exclusion_recommendations = flatten_data(
-        exclusion_recommendations)
 
-    sheet_handler.write_to_spreadsheet(
-        {_KEYWORDS_SHEET: flattened_kw_recommendations,
-         _EXCLUSIONS_SHEET: flattened_exclusion_recommendations})
+if __name__ == '__main__':
+    metrics.start_exporter_from_env()
+    report_path = run_from_ui(_parse_args(sys.argv[1:]), Config())
+    if report_path:
+        print(f'Profile report saved to {report_path}')
 
 
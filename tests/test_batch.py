@@ -0,0 +1,50 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from pathlib import Path
+from unittest import mock
+import yaml
+import batch
+
+_BATCH_PATH = Path(batch.__file__)
+
+
+def documented_config():
+    """Loads the batch.yaml example from batch.py's header comment."""
+    lines = _BATCH_PATH.read_text().splitlines()
+    start = lines.index('# batch.yaml:') + 1
+    example = []
+    for line in lines[start:]:
+        if not line.startswith('#'):
+            break
+        example.append(line[2:])
+    return yaml.safe_load('\n'.join(example))
+
+
+class DocumentedConfigTest(unittest.TestCase):
+
+    def test_documented_example_sets_up_every_run(self):
+        config = documented_config()
+
+        with mock.patch.object(batch.pool, 'get_client'):
+            runs = batch._create_runs(config['runs'])
+
+        self.assertEqual(len(runs), len(config['runs']))
+        self.assertEqual(runs[0].run_settings.start_date, '2023-01-01')
+        self.assertEqual(runs[0].run_settings.end_date, '2023-01-31')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import unittest
+from googleapiclient.errors import HttpError
+from utils.sheets import SheetsInteractor, _HEADER
+
+_URL = 'https://docs.google.com/spreadsheets/d/spreadsheet/edit'
+
+
+class _Request:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self):
+        return self._fn()
+
+
+class FakeSheetsService:
+    """In-memory spreadsheet applying values writes and row deletes like the Sheets API."""
+
+    def __init__(self, sheets):
+        self.sheets = {title: [list(row) for row in rows] for title, rows in sheets.items()}
+        self.fail_values_write = False
+        self.deleted_rows = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range=None, fields=None, valueRenderOption=None):
+        if range is None:
+            return _Request(lambda: {'sheets': [{'properties': {'title': title, 'sheetId': i}}
+                                                for i, title in enumerate(self.sheets)]})
+        sheet = range.split('!')[0].strip("'")
+        return _Request(lambda: {'values': [list(row) for row in self.sheets[sheet]]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        if 'requests' in body:
+            return _Request(lambda: self._apply_requests(body['requests']))
+        return _Request(lambda: self._write_values(body['data'], body['valueInputOption']))
+
+    def clear(self, spreadsheetId, range, body):
+        sheet = range.split('!')[0].strip("'")
+        return _Request(lambda: self.sheets[sheet].clear())
+
+    def _write_values(self, data, value_input_option):
+        if self.fail_values_write:
+            raise HttpError(type('Response', (), {'status': 500, 'reason': 'error'})(), b'')
+        for value_range in data:
+            sheet, cell = value_range['range'].split('!')
+            rows = self.sheets[sheet.strip("'")]
+            start = int(re.match(r'A(\d+)', cell).group(1)) - 1
+            for offset, row in enumerate(value_range['values']):
+                while len(rows) <= start + offset:
+                    rows.append([])
+                rows[start + offset] = [_user_entered(value) if value_input_option == 'USER_ENTERED' else value
+                                        for value in row]
+        return {'totalUpdatedRows': sum(len(value_range['values']) for value_range in data)}
+
+    def _apply_requests(self, requests):
+        titles = list(self.sheets)
+        for request in requests:
+            dimension_range = request['deleteDimension']['range']
+            rows = self.sheets[titles[dimension_range['sheetId']]]
+            del rows[dimension_range['startIndex']:dimension_range['endIndex']]
+            self.deleted_rows += dimension_range['endIndex'] - dimension_range['startIndex']
+        return {}
+
+
+def _user_entered(value):
+    """Parses text the way Sheets does for USER_ENTERED writes, for the cases that matter here."""
+    if not isinstance(value, str):
+        return value
+    if value.lower() == 'march 3':
+        return 46084
+    if value.startswith(('=', '+')):
+        return '#ERROR!'
+    return value
+
+
+def _row(keyword, clicks):
+    return [keyword, 'account', 1, 'campaign', 2, 'adgroup', 3, '', clicks, 10, 1, 5, 20]
+
+
+class DeltaWriteTest(unittest.TestCase):
+
+    def _write(self, existing, values, fail_values_write=False):
+        service = FakeSheetsService({'Keywords': existing})
+        service.fail_values_write = fail_values_write
+        SheetsInteractor(service, _URL).write_to_spreadsheet({'Keywords': values}, delta=True)
+        return service.sheets['Keywords']
+
+    def test_changed_new_and_removed_rows(self):
+        existing = [['old run'], _HEADER] + [_row(kw, 1) for kw in 'abcdefg']
+        # b and d..e removed, c and f changed, h and i new
+        values = [['new run'], _HEADER, _row('a', 1), _row('c', 2), _row('f', 2), _row('g', 1),
+                  _row('h', 1), _row('i', 1)]
+
+        self.assertEqual(self._write(existing, values), values)
+
+    def test_only_removed_rows(self):
+        existing = [['old run'], _HEADER] + [_row(kw, 1) for kw in 'abc']
+        values = [['new run'], _HEADER, _row('b', 1)]
+
+        self.assertEqual(self._write(existing, values), values)
+
+    def test_converted_keywords_are_kept_on_rewrite(self):
+        values = [['run'], _HEADER, _row('march 3', 1), _row('+ shoes', 1), _row('a', 1)]
+        service = FakeSheetsService({'Keywords': []})
+        interactor = SheetsInteractor(service, _URL)
+
+        interactor.write_to_spreadsheet({'Keywords': values}, delta=True)
+        interactor.write_to_spreadsheet({'Keywords': values}, delta=True)
+
+        self.assertEqual(service.sheets['Keywords'], values)
+        self.assertEqual(service.deleted_rows, 0)
+
+    def test_failed_values_write_keeps_sheet(self):
+        existing = [['old run'], _HEADER] + [_row(kw, 1) for kw in 'abc']
+        values = [['new run'], _HEADER, _row('a', 2), _row('d', 1)]
+
+        self.assertEqual(self._write(existing, values, fail_values_write=True), existing)
+
+
+if __name__ == '__main__':
+    unittest.main()
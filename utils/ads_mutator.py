@@ -13,6 +13,17 @@
 # limitations under the License.
 
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.ads.googleads.errors import GoogleAdsException
+from utils.service_pool import pool
+from utils import metrics
+from utils.quota import MUTATE
+
+# Both uploads and dry runs send this many operations per request
+_MUTATE_CHUNK_SIZE = 1000
+_VALIDATE_MAX_WORKERS = 8
+
 
 class Mutator(object):
     def __init__(self, client, customer_id):
@@ -20,20 +31,64 @@ class Mutator(object):
         self._customer_id = customer_id
 
 
+class DryRunReport:
+    """Outcome of a validate_only pass over planned negative keyword operations."""
+
+    def __init__(self, customer_id):
+        self.customer_id = customer_id
+        self.total_operations = 0
+        self.requests = 0
+        self.errors = []
+        self.request_latencies = []
+        # Operations left unvalidated because the run's operation budget was used up
+        self.skipped_operations = 0
+
+    @property
+    def failed_operations(self):
+        return len({(kw, ag_id) for kw, ag_id, _, _ in self.errors})
+
+    @property
+    def valid_operations(self):
+        return self.total_operations - self.failed_operations - self.skipped_operations
+
+    @property
+    def estimated_seconds(self):
+        """Upload sends the same chunks sequentially, so estimate it as one mean validate round trip per chunk."""
+        if not self.request_latencies:
+            return 0
+        mean_latency = sum(self.request_latencies) / len(self.request_latencies)
+        return mean_latency * self.requests
+
+    @property
+    def estimated_operations_cost(self):
+        """Every mutate operation counts against the developer token's daily quota."""
+        return self.valid_operations
+
+    def __repr__(self) -> str:
+        return (f'DryRunReport("{self.customer_id}", operations={self.total_operations}, '
+                f'failed={self.failed_operations}, skipped={self.skipped_operations}, estimated_seconds={self.estimated_seconds:.1f}, '
+                f'estimated_operations_cost={self.estimated_operations_cost})')
+
+
 class NegativeKeywordsUploader(Mutator):
-    def __init__(self, client, customer_id):
+    def __init__(self, client, customer_id, accountant=None, limiter=None):
         super().__init__(client, customer_id)
-        self._ad_group_service = client.get_service("AdGroupService")
-        self._ad_group_criterion_service = client.get_service(
-            "AdGroupCriterionService")
+        self._accountant = accountant
+        self._limiter = limiter
+        self._ad_group_service = pool.get_service(client, "AdGroupService")
+        self._ad_group_criterion_service = pool.get_service(
+            client, "AdGroupCriterionService")
 
-    def upload_from_script(self, keywords):
+    def _build_operations(self, keywords):
+        """Returns a list of (keyword, ad group id, operation) for every planned negative."""
         operations = []
         for kw, adgroups in keywords.items():
             for ag_id in adgroups:
+                if ag_id == 'prominent':
+                    continue
                 # Create keyword.
-                ad_group_criterion_operation = self._client.get_type(
-                    "AdGroupCriterionOperation")
+                ad_group_criterion_operation = pool.get_type(
+                    self._client, "AdGroupCriterionOperation")
                 ad_group_criterion = ad_group_criterion_operation.create
                 ad_group_criterion.ad_group = self._ad_group_service.ad_group_path(
                     self._customer_id, ag_id
@@ -44,15 +99,98 @@ class NegativeKeywordsUploader(Mutator):
                     self._client.enums.KeywordMatchTypeEnum.EXACT
                 )
                 ad_group_criterion.negative = True
-                operations.append(ad_group_criterion_operation)
+                operations.append((kw, ag_id, ad_group_criterion_operation))
+        return operations
 
-        ad_group_criterion_response = (
-            self._ad_group_criterion_service.mutate_ad_group_criteria(
-                request={'response_content_type': 'MUTABLE_RESOURCE',
-                         'customer_id': self._customer_id, 'operations': operations}
-            )
-        )
-        for result in ad_group_criterion_response.results:
-            logging.info(
-                f"Added negative keyword {result.ad_group_criterion.keyword.text} in ad group {result.ad_group_criterion.ad_group} ."
+    def upload_from_script(self, keywords, chunk_size=_MUTATE_CHUNK_SIZE):
+        """Uploads the planned operations as sequential partial failure requests of chunk_size
+        operations, the same requests validate_from_script validates. Returns the
+        (keyword, ad group id, code, message) errors of operations that weren't applied."""
+        planned = self._build_operations(keywords)
+        if self._accountant and not self._accountant.charge(
+                self._customer_id, 'upload', MUTATE, len(planned), optional=True):
+            logging.warning(
+                f"Skipped uploading {len(planned)} negative keywords to account {self._customer_id}, run operation budget reached.")
+            return []
+
+        errors = []
+        for chunk in _chunks(planned, chunk_size):
+            _, chunk_errors, response = self._mutate_chunk(chunk)
+            errors.extend(chunk_errors)
+            if response is None:
+                continue
+            for result in response.results:
+                # Failed operations have empty results
+                if result.resource_name:
+                    logging.info(
+                        f"Added negative keyword {result.ad_group_criterion.keyword.text} in ad group {result.ad_group_criterion.ad_group} ."
+                    )
+        for kw, ag_id, code, message in errors:
+            logging.error(f"Failed to add negative keyword {kw} in ad group {ag_id}: {code} {message}")
+        return errors
+
+    def validate_from_script(self, keywords, chunk_size=_MUTATE_CHUNK_SIZE, max_workers=_VALIDATE_MAX_WORKERS):
+        """Sends the planned operations as parallel validate_only requests without applying them."""
+        planned = self._build_operations(keywords)
+        report = DryRunReport(self._customer_id)
+        report.total_operations = len(planned)
+        if self._accountant and not self._accountant.charge(
+                self._customer_id, 'dry_run', MUTATE, len(planned), optional=True):
+            report.skipped_operations = len(planned)
+            logging.warning(report)
+            return report
+        chunks = _chunks(planned, chunk_size)
+        report.requests = len(chunks)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for latency, errors, _ in executor.map(
+                    lambda chunk: self._mutate_chunk(chunk, validate_only=True), chunks):
+                report.request_latencies.append(latency)
+                report.errors.extend(errors)
+
+        logging.info(report)
+        return report
+
+    def _mutate_chunk(self, chunk, validate_only=False):
+        """Sends one chunk with partial failure and returns its latency, (keyword, ad group id, code, message)
+        errors and the response, None if the whole request was rejected."""
+        kind = 'validate' if validate_only else 'upload'
+        errors = []
+        if self._limiter:
+            self._limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = self._ad_group_criterion_service.mutate_ad_group_criteria(
+                request={'customer_id': self._customer_id,
+                         'operations': [op for _, _, op in chunk],
+                         'partial_failure': True,
+                         'validate_only': validate_only,
+                         'response_content_type': 'MUTABLE_RESOURCE'}
             )
+        except GoogleAdsException as e:
+            metrics.MUTATE_SECONDS.observe(time.perf_counter() - start, kind=kind)
+            metrics.API_ERRORS.inc(call='mutate')
+            # The whole request was rejected, so every operation in it is reported.
+            for kw, ag_id, _ in chunk:
+                for error in e.failure.errors:
+                    errors.append((kw, ag_id, str(error.error_code), error.message))
+            return time.perf_counter() - start, errors, None
+        latency = time.perf_counter() - start
+        metrics.MUTATE_SECONDS.observe(latency, kind=kind)
+
+        partial_failure = response.partial_failure_error
+        if not partial_failure.details:
+            return latency, errors, response
+
+        failure_type = pool.get_type_class(self._client, "GoogleAdsFailure")
+        for detail in partial_failure.details:
+            failure = failure_type.deserialize(detail.value)
+            for error in failure.errors:
+                index = error.location.field_path_elements[0].index
+                kw, ag_id, _ = chunk[index]
+                errors.append((kw, ag_id, str(error.error_code), error.message))
+        return latency, errors, response
+
+
+def _chunks(planned, chunk_size):
+    return [planned[i:i + chunk_size] for i in range(0, len(planned), chunk_size)]
@@ -12,27 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from utils.keyword_index import hash_keywords
+from utils.service_pool import pool
+from utils import metrics
+import time
+
+
 class Builder(object):
-    def __init__(self, client, customer_id):
-        self._service = client.get_service('GoogleAdsService')
+    _phase = 'search'
+
+    def __init__(self, client, customer_id, accountant=None, limiter=None):
+        self._service = pool.get_service(client, 'GoogleAdsService')
         self._client = client
         self._customer_id = customer_id
+        self._accountant = accountant
+        self._limiter = limiter
         self._enums = {
-            'match_type': client.get_type('KeywordMatchTypeEnum').KeywordMatchType
+            'match_type': pool.get_type(client, 'KeywordMatchTypeEnum').KeywordMatchType
         }
 
-    def _get_rows(self, query):
-        search_request = self._client.get_type("SearchGoogleAdsStreamRequest")
+    def _get_rows(self, query, phase=None, optional=False):
+        if self._accountant and not self._accountant.charge(
+                self._customer_id, phase or self._phase, optional=optional):
+            return []
+        if self._limiter:
+            self._limiter.acquire()
+        search_request = pool.get_type(self._client, "SearchGoogleAdsStreamRequest")
         search_request.customer_id = self._customer_id
         search_request.query = query
+        start = time.perf_counter()
         response = self._service.search_stream(request=search_request)
-        return response
+        return metrics.timed_stream(response, start)
 
 
 class SearchTermBuilder(Builder):
     """Gets Keywords recommednations from a single account."""
+    _phase = 'search_terms'
 
-    def build(self, thresholds, start_date, end_date):
+    def build(self, thresholds, start_date, end_date, filter_conversions=True):
+        """Without filter_conversions, search terms at or below the conversions threshold are
+        returned too, see only_converting."""
+        conversions_filter = (f"AND metrics.conversions > {thresholds['conversions']}"
+                              if filter_conversions else '')
         query = f"""
             SELECT 
                 search_term_view.search_term,
@@ -57,7 +78,7 @@ class SearchTermBuilder(Builder):
                 AND metrics.impressions >= {thresholds['impressions']} 
                 AND metrics.ctr > {thresholds['ctr']} 
                 AND metrics.cost_micros > {thresholds['cost']} 
-                AND metrics.conversions > {thresholds['conversions']}
+                {conversions_filter}
                 AND segments.date BETWEEN '{start_date}' AND '{end_date}'
         """
 
@@ -100,13 +121,28 @@ class SearchTermBuilder(Builder):
 
         return search_terms
 
+    @staticmethod
+    def only_converting(search_terms, thresholds):
+        """Drops search term ad groups at or below the conversions threshold, in place"""
+        threshold = float(thresholds['conversions'])
+        for st in list(search_terms):
+            st_stats = search_terms[st]
+            for ag_id in list(st_stats):
+                if st_stats[ag_id]['conversions'] <= threshold:
+                    st_stats.pop(ag_id)
+            if not st_stats:
+                search_terms.pop(st)
+        return search_terms
+
 
 class KeywordDedupingBuilder(Builder):
     """Gets Keywords from a single account, removes if from search term dict if
     KW exist in the same ad group. If exist in a different ad group, adds to exclusion list with
-    to be add as negative kw in the st's original ad group."""
+    to be add as negative kw in the st's original ad group. Search terms that are already
+    excluded by an ad group or campaign negative keyword are dropped."""
+    _phase = 'dedup'
 
-    def build(self, search_terms):
+    def build(self, search_terms, keyword_index=None):
         rows = self._get_rows('''
         SELECT
             ad_group_criterion.keyword.text,
@@ -125,14 +161,20 @@ class KeywordDedupingBuilder(Builder):
         ''')
 
         # Create a dict of keywords that appear in the search term list
-        # and all the ad groups they exist in
+        # and all the ad groups they exist in, and a set of the
+        # (ad group, text) pairs of existing negatives
         keywords = {}
+        ad_group_negatives = set()
         for batch in rows:
             for row in batch.results:
                 row = row._pb
                 # if keyword is not in search term dict, move on to the next one
                 if not search_terms.get(row.ad_group_criterion.keyword.text):
                     continue
+                if row.ad_group_criterion.negative:
+                    ad_group_negatives.add(
+                        (row.ad_group.id, row.ad_group_criterion.keyword.text))
+                    continue
                 try:
                     keywords[row.ad_group_criterion.keyword.text].append(
                         row.ad_group.id)
@@ -140,11 +182,17 @@ class KeywordDedupingBuilder(Builder):
                     keywords[row.ad_group_criterion.keyword.text] = [
                         row.ad_group.id]
 
+        self._remove_excluded(search_terms, ad_group_negatives,
+                              self._get_campaign_negatives(search_terms))
+
         # Create exclusion dict of negative keywords. Will have search terms
         # that appear in other ad groups as keywords.
         exclusion_list = {}
         for kw, kw_ags in keywords.items():
-            st_stats = search_terms[kw]
+            st_stats = search_terms.get(kw)
+            # Every ad group of this search term already excludes it
+            if not st_stats:
+                continue
             for ag in kw_ags:
                 if st_stats.get(ag):
                     st_stats.pop(ag)
@@ -154,10 +202,60 @@ class KeywordDedupingBuilder(Builder):
                 exclusion_list[kw]['prominent'] = self._get_prominent_existing_location(kw)
             search_terms.pop(kw)
 
+        # Remaining search terms are new keywords, unless a sister account under
+        # the MCC already has them
+        if keyword_index is not None and search_terms:
+            texts = list(search_terms)
+            for st, elsewhere in zip(texts, keyword_index.in_other_accounts(texts, self._customer_id)):
+                if elsewhere:
+                    search_terms.pop(st)
+
         return exclusion_list
 
+    def _get_campaign_negatives(self, search_terms):
+        """Returns a set of (campaign id, text) pairs of campaign negatives matching search terms"""
+        rows = self._get_rows('''
+        SELECT
+            campaign_criterion.keyword.text,
+            campaign.id
+        FROM
+            campaign_criterion
+        WHERE
+            campaign_criterion.type = KEYWORD
+        AND
+            campaign_criterion.negative = TRUE
+        AND
+            campaign_criterion.status != 'REMOVED'
+        AND
+            campaign.advertising_channel_type = 'SEARCH'
+        ''')
+
+        campaign_negatives = set()
+        for batch in rows:
+            for row in batch.results:
+                row = row._pb
+                if search_terms.get(row.campaign_criterion.keyword.text):
+                    campaign_negatives.add(
+                        (row.campaign.id, row.campaign_criterion.keyword.text))
+        return campaign_negatives
+
+    @staticmethod
+    def _remove_excluded(search_terms, ad_group_negatives, campaign_negatives):
+        """Removes search term ad groups where the term is already a negative keyword"""
+        if not ad_group_negatives and not campaign_negatives:
+            return
+        for st in list(search_terms):
+            st_stats = search_terms[st]
+            for ag_id in list(st_stats):
+                if ((ag_id, st) in ad_group_negatives
+                        or (st_stats[ag_id]['campaign_id'], st) in campaign_negatives):
+                    st_stats.pop(ag_id)
+            if not st_stats:
+                search_terms.pop(st)
+
     def _get_prominent_existing_location(self, kw):
-        """For given KW, get the ad group and campaign names where this KW has the largest cost"""
+        """For given KW, get the ad group and campaign names where this KW has the largest cost.
+        Skipped, returning None, once the run's operation budget is used up."""
         rows = self._get_rows(f'''
             SELECT 
                 campaign.name, 
@@ -169,7 +267,7 @@ class KeywordDedupingBuilder(Builder):
             ORDER BY 
                 metrics.cost_micros DESC 
             LIMIT 1 
-            ''')
+            ''', phase='prominent', optional=True)
 
         for batch in rows:
             for row in batch.results:
@@ -177,11 +275,67 @@ class KeywordDedupingBuilder(Builder):
                 return row.campaign.name + '~' + row.ad_group.name
 
 
+class AccountKeywordsBuilder(Builder):
+    """Gets the hashed positive keywords of a single account, a shard of the MCC-wide keyword index."""
+    _phase = 'keyword_index'
+
+    def build(self):
+        rows = self._get_rows('''
+        SELECT
+            ad_group_criterion.keyword.text
+        FROM
+            ad_group_criterion
+        WHERE
+            ad_group_criterion.type = KEYWORD
+        AND
+            ad_group_criterion.negative = FALSE
+        AND
+            ad_group_criterion.status IN ('ENABLED', 'PAUSED')
+        AND
+            campaign.advertising_channel_type = 'SEARCH'
+        ''')
+
+        return hash_keywords(row._pb.ad_group_criterion.keyword.text
+                             for batch in rows for row in batch.results)
+
+
+class AccountSizeBuilder(Builder):
+    """Gets the total search traffic of a single account, used to schedule and skip accounts."""
+    _phase = 'size'
+
+    def build(self, start_date, end_date):
+        query = f"""
+            SELECT
+                metrics.clicks,
+                metrics.impressions,
+                metrics.cost_micros,
+                metrics.conversions
+            FROM
+                campaign
+            WHERE
+                campaign.advertising_channel_type = 'SEARCH'
+                AND segments.date BETWEEN '{start_date}' AND '{end_date}'
+        """
+
+        size = {'clicks': 0, 'impressions': 0, 'cost_micros': 0, 'conversions': 0}
+        rows = self._get_rows(query)
+        for batch in rows:
+            for row in batch.results:
+                row = row._pb
+                size['clicks'] += row.metrics.clicks
+                size['impressions'] += row.metrics.impressions
+                size['cost_micros'] += row.metrics.cost_micros
+                size['conversions'] += row.metrics.conversions
+
+        return size
+
+
 class AccountsBuilder(Builder):
     """Gets all client accounts' IDs under the MCC."""
+    _phase = 'accounts'
 
-    def __init__(self, client):
-        super().__init__(client, client.login_customer_id)
+    def __init__(self, client, accountant=None, limiter=None):
+        super().__init__(client, client.login_customer_id, accountant, limiter)
         self._client = client
 
     def get_accounts(self, with_names=False):
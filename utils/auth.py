@@ -24,7 +24,6 @@ import sys
 import webbrowser
 from urllib.parse import unquote
 from yaml.loader import SafeLoader
-from google_auth_oauthlib.flow import Flow
 
 SCOPES = ['https://www.googleapis.com/auth/adwords', 'https://www.googleapis.com/auth/spreadsheets',
           'https://www.googleapis.com/auth/drive.file', 'https://www.googleapis.com/auth/drive']
@@ -35,6 +34,9 @@ CONFIG_FILE = './config.yaml'
 
 
 def main(ga_config=None):
+    # Imported here so modules that only need SCOPES don't pay for the OAuth flow imports
+    from google_auth_oauthlib.flow import Flow
+
     if not ga_config:
         ga_config = get_config(CONFIG_FILE)
     # If YAML values are not filled out, return and display error
@@ -14,22 +14,31 @@
 
 from yaml.loader import SafeLoader
 from copy import deepcopy
-from google.cloud import storage
-from google.ads.googleads.client import GoogleAdsClient
 from typing import Dict
 import os
 import yaml
 
 
-BUCKET_NAME = os.getenv('bucket_name')
+BUCKET_NAME = os.getenv('bucket_name', '')
 CONFIG_FILE_NAME = 'config.yaml'
 CONFIG_FILE_PATH = BUCKET_NAME +  '/' + CONFIG_FILE_NAME
 
+_bucket = None
+
+
+def _get_bucket():
+    """Creates the storage client on first use and shares it between sessions."""
+    global _bucket
+    if _bucket is None:
+        # Imported here to keep it off the container's cold start path
+        from google.cloud import storage
+        _bucket = storage.Client().bucket(BUCKET_NAME)
+    return _bucket
+
+
 class Config:
     def __init__(self) -> None:
         self.file_path = CONFIG_FILE_PATH
-        self.storage_client = storage.Client()
-        self.bucket = self.storage_client.bucket(BUCKET_NAME)
         config = self.load_config_from_file()
         if config is None:
             config = {}
@@ -42,6 +51,10 @@ class Config:
         self.spreadsheet_url = config.get('spreadsheet_url', '')
         self.check_valid_config()
 
+    @property
+    def bucket(self):
+        return _get_bucket()
+
     def check_valid_config(self):
         if self.client_id and self.client_secret and self.refresh_token and self.developer_token and self.login_customer_id:
             self.valid_config = True
@@ -81,7 +94,8 @@ class Config:
         }
 
     def get_ads_client(self):
-        return GoogleAdsClient.load_from_dict({
+        from utils.service_pool import pool
+        return pool.get_client({
             'client_id': self.client_id,
             'client_secret': self.client_secret,
             'login_customer_id': self.login_customer_id,
@@ -15,9 +15,16 @@
 from typing import List, Dict, Any
 from dateutil.parser import parse
 
+_FLAGS = ('mcc_wide_dedup', 'ngram_analysis', 'delta_writes')
+_RANKING_OPTIONS = ('top_k', 'rank_metric', 'rank_by')
+_QUOTA_OPTIONS = ('quota_budget', 'quota_mode')
+
 
 class RunSettings:
-    def __init__(self, thresholds: Dict[str, str], start_date: str, end_date: str, accounts: List[str] = []):
+    def __init__(self, thresholds: Dict[str, str], start_date: str, end_date: str, accounts: List[str] = [],
+                 mcc_wide_dedup: bool = False, ngram_analysis: bool = False, delta_writes: bool = False,
+                 top_k: int = 0, rank_metric: str = 'cost', rank_by: str = 'account',
+                 quota_budget: int = 0, quota_mode: str = 'soft'):
         if not start_date or not end_date:
             raise ValueError(
                 "Start and end dates must be provided in settings sheet.")
@@ -28,16 +35,50 @@ class RunSettings:
         self.start_date = parse(start_date).strftime("%Y-%m-%d")
         self.end_date = parse(end_date).strftime("%Y-%m-%d")
         self.accounts = accounts
+        # Also drop new keyword recommendations that are keywords in other accounts of the MCC
+        self.mcc_wide_dedup = mcc_wide_dedup
+        # Write wasteful n-grams across search terms to a separate sheet
+        self.ngram_analysis = ngram_analysis
+        # Only write rows that changed since the previous run to the results spreadsheet
+        self.delta_writes = delta_writes
+        # Keep only the top K rows per account or campaign in the output sheets, 0 keeps all
+        self.top_k = int(top_k or 0)
+        self.rank_metric = rank_metric
+        self.rank_by = rank_by
+        # Google Ads API operations a run may use, 0 is unlimited. Soft mode warns and
+        # hard mode stops once it's reached, optional work is skipped in both
+        self.quota_budget = int(quota_budget or 0)
+        self.quota_mode = quota_mode
 
         # Convert cost to cost micros
         self.thresholds['cost'] = str(int(self.thresholds['cost']) * 1000000)
 
+    def has_qualifying_traffic(self, size: Dict[str, float]) -> bool:
+        """Checks account totals against the thresholds. A search term's metrics can't exceed
+        its account's totals, so an account failing them can't have any qualifying search term.
+        With n-gram analysis, non converting search terms are mined too, so conversions aren't checked."""
+        return (size['impressions'] > 0
+                and size['clicks'] >= float(self.thresholds['clicks'])
+                and size['impressions'] >= float(self.thresholds['impressions'])
+                and size['cost_micros'] > float(self.thresholds['cost'])
+                and (self.ngram_analysis or size['conversions'] > float(self.thresholds['conversions'])))
+
+    def max_search_term_rows(self, size: Dict[str, float]) -> int:
+        """Upper bound of an account's qualifying search term rows from its totals. Every row has
+        at least one impression and meets the clicks and impressions thresholds."""
+        rows = size['impressions'] // max(1, float(self.thresholds['impressions']))
+        clicks = float(self.thresholds['clicks'])
+        if clicks > 0:
+            rows = min(rows, size['clicks'] // clicks)
+        return int(rows)
+
     @staticmethod
     def from_sheet_read(input: List[List[str]]):
         thresholds = {}
         start_date = ''
         end_date = ''
         accounts = ''
+        flags = {}
 
         for list in input:
             key = list[0]
@@ -55,11 +96,15 @@ class RunSettings:
                     accounts = []
                 else:
                     accounts = str(value).split(',')
+            elif key in _FLAGS:
+                flags[key] = str(value).lower() in ('true', '1', 'yes')
+            elif key in _RANKING_OPTIONS or key in _QUOTA_OPTIONS:
+                flags[key] = value
 
             else:
                 thresholds[key] = value
 
-        return RunSettings(thresholds, start_date, end_date, accounts)
+        return RunSettings(thresholds, start_date, end_date, accounts, **flags)
 
     @staticmethod
     def from_dict(input:Dict[Any, Any]):
@@ -71,7 +116,10 @@ class RunSettings:
             'ctr': input.get('ctr', 0)
         }
 
-        return RunSettings(thresholds=thresholds, start_date=input['start_date'], end_date=input['end_date'], accounts=input.get('accounts', []))
+        # YAML configs load unquoted dates as datetime.date
+        return RunSettings(thresholds=thresholds, start_date=str(input['start_date']), end_date=str(input['end_date']), accounts=input.get('accounts', []),
+                           **{flag: bool(input.get(flag, False)) for flag in _FLAGS},
+                           **{option: input[option] for option in _RANKING_OPTIONS + _QUOTA_OPTIONS if input.get(option)})
 
     def __repr__(self) -> str:
-        return f'RunSettings("{self.thresholds}", "{self.start_date}", "{self.end_date}", "{self.accounts}")'
+        return f'RunSettings("{self.thresholds}", "{self.start_date}", "{self.end_date}", "{self.accounts}", mcc_wide_dedup={self.mcc_wide_dedup}, ngram_analysis={self.ngram_analysis}, delta_writes={self.delta_writes}, top_k={self.top_k}, rank_metric="{self.rank_metric}", rank_by="{self.rank_by}", quota_budget={self.quota_budget}, quota_mode="{self.quota_mode}")'
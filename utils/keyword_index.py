@@ -0,0 +1,87 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import threading
+from typing import Iterable, List
+import numpy as np
+
+
+def keyword_hash(text: str) -> int:
+    """Stable 64 bit hash of a keyword text."""
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+
+def hash_keywords(texts: Iterable[str]) -> np.ndarray:
+    """Returns the sorted unique hashes of `texts`, the shard of a single account."""
+    return np.unique(np.fromiter((keyword_hash(t) for t in texts), dtype=np.uint64))
+
+
+class KeywordIndex:
+    """MCC-wide index of positive keywords, built once per run.
+
+    Shards are added per account as sorted arrays of 64 bit keyword hashes and
+    merged into three parallel arrays: the unique hashes, the first account each
+    hash was seen in and whether it was seen in more than one account. Lookups are
+    a binary search, so querying never rescans any account. Hash collisions can
+    make a keyword look present in a sister account, at a rate of about n/2^64.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._shards = []
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._first_account = np.empty(0, dtype=np.int32)
+        self._shared = np.empty(0, dtype=bool)
+
+    def add_shard(self, account: str, hashes: np.ndarray):
+        with self._lock:
+            account_index = self._accounts.setdefault(str(account), len(self._accounts))
+            self._shards.append(
+                (hashes, np.full(len(hashes), account_index, dtype=np.int32)))
+
+    def freeze(self):
+        """Merges added shards into the lookup arrays and releases them."""
+        with self._lock:
+            if not self._shards:
+                return
+            hashes = np.concatenate([self._hashes] + [h for h, _ in self._shards])
+            accounts = np.concatenate([self._first_account] + [a for _, a in self._shards])
+            shared = np.concatenate([self._shared] + [np.zeros(len(h), dtype=bool) for h, _ in self._shards])
+            self._shards = []
+
+            order = np.argsort(hashes, kind='stable')
+            hashes, accounts, shared = hashes[order], accounts[order], shared[order]
+            unique, first, counts = np.unique(hashes, return_index=True, return_counts=True)
+            # Shards hold unique hashes, so repeats of a hash come from different accounts
+            shared_any = np.logical_or.reduceat(shared, first) if len(first) else shared
+            self._hashes = unique
+            self._first_account = accounts[first]
+            self._shared = (counts > 1) | shared_any
+
+    def in_other_accounts(self, texts: List[str], account: str) -> np.ndarray:
+        """Returns a boolean array, True where the text is a keyword in an account other than `account`."""
+        if not len(self._hashes) or not texts:
+            return np.zeros(len(texts), dtype=bool)
+        queries = np.fromiter((keyword_hash(t) for t in texts), dtype=np.uint64, count=len(texts))
+        positions = np.searchsorted(self._hashes, queries)
+        positions = np.minimum(positions, len(self._hashes) - 1)
+        found = self._hashes[positions] == queries
+        account_index = self._accounts.get(str(account), -1)
+        elsewhere = self._shared[positions] | (self._first_account[positions] != account_index)
+        return found & elsewhere
+
+    def __len__(self):
+        return len(self._hashes)
@@ -0,0 +1,188 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Minimal in-process metrics exposed in the Prometheus text format.
+# Recording is always on and costs a lock and a dict update. The HTTP
+# exporter only starts when the `metrics_port` env variable is set.
+
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_RUN_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+
+class _Metric:
+    _type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self._type}']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {value}']
+
+
+class Counter(_Metric):
+    _type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    _type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    _type = 'histogram'
+
+    def __init__(self, name, description, buckets=_LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Bucket counts, then the +Inf bucket, then the sum
+                counts = self._values[key] = [0] * (len(self._buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + ('+Inf',), counts[:-1]):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {counts[-1]}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+SEARCH_STREAM_SECONDS = Histogram('seatera_search_stream_seconds',
+                                  'Time to fully consume a search_stream call.')
+MUTATE_SECONDS = Histogram('seatera_mutate_seconds',
+                           'Latency of mutate calls, by validate_only or upload.')
+ROWS_STREAMED = Counter('seatera_rows_streamed_total',
+                        'Rows streamed from search_stream calls, use rate() for rows per second.')
+API_ERRORS = Counter('seatera_api_errors_total', 'Failed Google Ads API calls, by call.')
+IN_FLIGHT_ACCOUNTS = Gauge('seatera_in_flight_accounts', 'Accounts currently being processed.')
+SHEETS_WRITE_SECONDS = Histogram('seatera_sheets_write_seconds', 'Latency of writing results to Sheets.')
+RUN_SECONDS = Histogram('seatera_run_seconds', 'Duration of full runs, single MCC runs or whole batches by kind.',
+                        buckets=_RUN_BUCKETS)
+
+REGISTRY = (SEARCH_STREAM_SECONDS, MUTATE_SECONDS, ROWS_STREAMED, API_ERRORS,
+            IN_FLIGHT_ACCOUNTS, SHEETS_WRITE_SECONDS, RUN_SECONDS)
+
+
+def timed_stream(response, start):
+    """Passes search_stream batches through, counting rows and timing the whole stream."""
+    try:
+        for batch in response:
+            ROWS_STREAMED.inc(len(batch.results))
+            yield batch
+    except Exception:
+        API_ERRORS.inc(call='search_stream')
+        raise
+    finally:
+        SEARCH_STREAM_SECONDS.observe(time.perf_counter() - start)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_exporter(port, address='127.0.0.1'):
+    """Serves /metrics on a daemon thread. Only the first call in a process starts a server."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((address, int(port)), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            logging.info(f'Metrics exporter listening on {address}:{_server.server_port}')
+        return _server
+
+
+def start_exporter_from_env():
+    port = os.getenv('metrics_port')
+    if port:
+        return start_exporter(port)
+    return None
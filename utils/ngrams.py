@@ -0,0 +1,85 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Finds wasteful words and phrases across the search terms of an account.
+# Each search term is tokenized once, and metrics are aggregated per n-gram
+# with numpy instead of per-row Python loops.
+
+from typing import Any, Dict, List
+import numpy as np
+
+_MAX_N = 3
+_MIN_TERMS = 2
+_MAX_ROWS = 1000
+_METRICS = ('clicks', 'impressions', 'cost', 'conversions')
+
+
+def mine_ngrams(search_terms: Dict[str, Dict[Any, Any]],
+                max_n: int = _MAX_N,
+                min_terms: int = _MIN_TERMS,
+                max_rows: int = _MAX_ROWS) -> List[List[Any]]:
+    """Returns [ngram, n, search terms, clicks, impressions, cost, conversions, cost per conversion]
+    rows for n-grams appearing in at least `min_terms` search terms, most wasteful first:
+    n-grams without conversions, then by cost per conversion, then by cost."""
+    if not search_terms:
+        return []
+
+    # Sum metrics of each search term over its ad groups
+    term_ids, values = [], []
+    for term_id, ad_groups in enumerate(search_terms.values()):
+        for key, stats in ad_groups.items():
+            if key == 'prominent':
+                continue
+            term_ids.append(term_id)
+            values.append([stats[m] for m in _METRICS])
+    term_totals = np.zeros((len(search_terms), len(_METRICS)))
+    np.add.at(term_totals, np.asarray(term_ids), np.asarray(values, dtype=float))
+
+    # Tokenize once, counting every n-gram at most once per search term
+    ngram_ids = {}
+    occurrence_ngrams, occurrence_terms = [], []
+    for term_id, term in enumerate(search_terms):
+        tokens = term.split()
+        seen = set()
+        for n in range(1, max_n + 1):
+            for i in range(len(tokens) - n + 1):
+                ngram = ' '.join(tokens[i:i + n])
+                if ngram in seen:
+                    continue
+                seen.add(ngram)
+                occurrence_ngrams.append(ngram_ids.setdefault(ngram, len(ngram_ids)))
+                occurrence_terms.append(term_id)
+    if not ngram_ids:
+        return []
+
+    occurrence_ngrams = np.asarray(occurrence_ngrams)
+    occurrence_terms = np.asarray(occurrence_terms)
+    size = len(ngram_ids)
+    terms = np.bincount(occurrence_ngrams, minlength=size)
+    totals = np.stack([np.bincount(occurrence_ngrams, weights=term_totals[occurrence_terms, m], minlength=size)
+                       for m in range(len(_METRICS))], axis=1)
+    clicks, impressions, cost, conversions = totals.T
+    cost_per_conversion = np.divide(cost, conversions, out=np.full(size, np.inf), where=conversions > 0)
+
+    candidates = np.flatnonzero(terms >= min_terms)
+    order = candidates[np.lexsort((-cost[candidates],
+                                   -cost_per_conversion[candidates],
+                                   conversions[candidates] > 0))][:max_rows]
+
+    ngrams = np.empty(size, dtype=object)
+    ngrams[list(ngram_ids.values())] = list(ngram_ids.keys())
+    return [[ngrams[i], ngrams[i].count(' ') + 1, int(terms[i]), int(clicks[i]), int(impressions[i]),
+             round(float(cost[i]), 2), round(float(conversions[i]), 2),
+             '' if np.isinf(cost_per_conversion[i]) else round(float(cost_per_conversion[i]), 2)]
+            for i in order]
@@ -0,0 +1,216 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+_SAMPLE_INTERVAL_SECONDS = 0.005
+_TRACEMALLOC_FRAMES = 10
+_TOP_FUNCTIONS = 30
+_TOP_ALLOCATIONS = 10
+# A new peak snapshot is taken once traced memory grew this much over the last one
+_SNAPSHOT_GROWTH_RATIO = 1.25
+_SNAPSHOT_MIN_GROWTH_BYTES = 2**20
+PROFILE_REPORT_PATH = Path('./profile_report.txt')
+
+
+class _PhaseStats:
+    def __init__(self):
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.snapshot_bytes = 0
+        self.snapshot = None
+
+
+class RunProfiler:
+    """Wraps a single run with CPU sampling and tracemalloc allocation tracking.
+
+    A background thread samples the stacks of the run's threads: the thread that
+    entered the profiler and threads started during the run, such as executor
+    workers. Threads that already existed, like a web server's or other sessions',
+    are left out. Each sample is weighted by the CPU time its thread used since
+    the previous sample, so threads blocked on locks, queues or the network don't
+    count. Where per-thread CPU clocks are unavailable, samples count wall time.
+    When disabled all methods are no-ops.
+    """
+
+    def __init__(self, enabled=False, interval=_SAMPLE_INTERVAL_SECONDS):
+        self.enabled = enabled
+        self._interval = interval
+        self._phase = 'other'
+        self._phases = {}
+        self._self_samples = Counter()
+        self._total_samples = Counter()
+        self._phase_samples = Counter()
+        self._stop = threading.Event()
+        self._paused = False
+        self._sampler = None
+        self._started_at = None
+        self._elapsed = 0.0
+        self._owner = None
+        self._preexisting = set()
+        self._last_cpu = {}
+        self._cpu_clocks = True
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        tracemalloc.start(_TRACEMALLOC_FRAMES)
+        self._owner = threading.get_ident()
+        self._preexisting = set(sys._current_frames()) - {self._owner}
+        self._started_at = time.perf_counter()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if not self.enabled:
+            return False
+        self._stop.set()
+        self._sampler.join()
+        self._elapsed = time.perf_counter() - self._started_at
+        tracemalloc.stop()
+        return False
+
+    @contextmanager
+    def phase(self, name):
+        """Attributes samples, wall time and peak memory inside the block to `name`."""
+        if not self.enabled:
+            yield
+            return
+        previous = self._phase
+        self._phase = name
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            stats = self._phases.setdefault(name, _PhaseStats())
+            stats.seconds += time.perf_counter() - start
+            stats.peak_bytes = max(stats.peak_bytes, peak)
+            if stats.snapshot is None:
+                # Phase too short for the sampler to see its peak, snapshot what is left.
+                self._paused = True
+                stats.snapshot_bytes = tracemalloc.get_traced_memory()[0]
+                stats.snapshot = tracemalloc.take_snapshot()
+                self._paused = False
+            self._phase = previous
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            if self._paused:
+                continue
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or thread_id in self._preexisting:
+                    continue
+                weight = self._cpu_weight(thread_id)
+                if not weight:
+                    continue
+                self._phase_samples[self._phase] += weight
+                self._self_samples[_frame_key(frame)] += weight
+                seen = set()
+                while frame is not None:
+                    key = _frame_key(frame)
+                    if key not in seen:
+                        self._total_samples[key] += weight
+                        seen.add(key)
+                    frame = frame.f_back
+            self._snapshot_peak()
+
+    def _snapshot_peak(self):
+        """Snapshots allocations when traced memory reached a new high of the current phase.
+
+        Taken from the sampler while memory is high, per account data is freed by phase end.
+        Grouping the snapshot is slow, so it is left to the report."""
+        current, peak = tracemalloc.get_traced_memory()
+        stats = self._phases.setdefault(self._phase, _PhaseStats())
+        stats.peak_bytes = max(stats.peak_bytes, peak)
+        if (current < stats.snapshot_bytes * _SNAPSHOT_GROWTH_RATIO
+                or current - stats.snapshot_bytes < _SNAPSHOT_MIN_GROWTH_BYTES):
+            return
+        stats.snapshot = None
+        stats.snapshot_bytes = current
+        stats.snapshot = tracemalloc.take_snapshot()
+        # Keep the snapshot's own memory out of the phase peak
+        tracemalloc.reset_peak()
+
+    def _cpu_weight(self, thread_id):
+        """Seconds of CPU the thread used since its previous sample, 0 the first time it's seen."""
+        if not self._cpu_clocks:
+            return self._interval
+        try:
+            cpu = time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+        except AttributeError:
+            self._cpu_clocks = False
+            return self._interval
+        except OSError:
+            # The thread has exited
+            return 0
+        previous = self._last_cpu.get(thread_id, cpu)
+        self._last_cpu[thread_id] = cpu
+        return cpu - previous
+
+    def report(self):
+        clock = 'CPU' if self._cpu_clocks else 'wall'
+        lines = [f'Run wall time: {self._elapsed:.2f}s, {sum(self._phase_samples.values()):.2f}s of '
+                 f'{clock} time sampled every {self._interval * 1000:.0f}ms', '']
+
+        lines.append('Phases')
+        lines.append(f'{"phase":<24}{"seconds":>10}{clock + " s":>10}{"peak MB":>10}')
+        for name, stats in self._phases.items():
+            lines.append(f'{name:<24}{stats.seconds:>10.2f}{self._phase_samples[name]:>10.2f}'
+                         f'{stats.peak_bytes / 2**20:>10.1f}')
+        lines.append('')
+
+        lines.append(f'Hot functions (self {clock} ms)')
+        for key, seconds in self._self_samples.most_common(_TOP_FUNCTIONS):
+            lines.append(f'{seconds * 1000:>8.0f}  {key}')
+        lines.append('')
+
+        lines.append(f'Hot functions (inclusive {clock} ms)')
+        for key, seconds in self._total_samples.most_common(_TOP_FUNCTIONS):
+            lines.append(f'{seconds * 1000:>8.0f}  {key}')
+        lines.append('')
+
+        for name, stats in self._phases.items():
+            if stats.snapshot is None:
+                continue
+            lines.append(f'Largest allocations at the memory peak of phase "{name}" '
+                         f'({stats.snapshot_bytes / 2**20:.1f} MB traced)')
+            for stat in stats.snapshot.statistics('lineno')[:_TOP_ALLOCATIONS]:
+                lines.append(f'  {stat}')
+            lines.append('')
+
+        return '\n'.join(lines)
+
+    def save_report(self, path=PROFILE_REPORT_PATH):
+        if not self.enabled:
+            return None
+        Path(path).write_text(self.report())
+        logging.info(f'Profile report saved to {path}')
+        return path
+
+
+def _frame_key(frame):
+    code = frame.f_code
+    return f'{code.co_filename}:{code.co_firstlineno}({code.co_name})'
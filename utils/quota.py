@@ -0,0 +1,99 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Accounting of Google Ads API operations against the developer token's daily
+# quota. Every search or search_stream request is one operation, and every
+# mutate operation is one operation, validate_only included.
+
+import logging
+import threading
+from collections import defaultdict
+from typing import Any, Dict, List
+
+QUOTA_MODES = ('soft', 'hard')
+SEARCH = 'search'
+MUTATE = 'mutate'
+
+
+class QuotaBudgetExceeded(Exception):
+    pass
+
+
+class OperationAccountant:
+    """Counts operations per account and phase against an optional per-run budget.
+
+    Work that can be left out (prominent ad group lookups, dry run validation and
+    uploads) is skipped once it would go over the budget. Other work goes on in
+    soft mode with a warning, and raises QuotaBudgetExceeded in hard mode before
+    the request is sent. A budget of 0 only counts.
+    """
+
+    def __init__(self, budget: int = 0, mode: str = 'soft'):
+        if mode not in QUOTA_MODES:
+            raise ValueError(f"Quota mode must be one of {', '.join(QUOTA_MODES)}.")
+        self.budget = budget
+        self.mode = mode
+        self.estimate = None
+        self._lock = threading.Lock()
+        self._used = 0
+        self._counts = defaultdict(lambda: {SEARCH: 0, MUTATE: 0})
+        self._skipped = defaultdict(int)
+        self._warned = False
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    def charge(self, account: str, phase: str, kind: str = SEARCH, operations: int = 1,
+               optional: bool = False) -> bool:
+        """Records operations about to be sent. Returns False if optional work should be skipped."""
+        with self._lock:
+            if self.budget and self._used + operations > self.budget:
+                if optional:
+                    self._skipped[phase] += operations
+                    return False
+                if self.mode == 'hard':
+                    raise QuotaBudgetExceeded(
+                        f"Run budget of {self.budget} operations reached, stopped before {phase} of account {account}.")
+                if not self._warned:
+                    logging.warning(f"Run budget of {self.budget} operations exceeded, continuing in soft mode.")
+                    self._warned = True
+            self._used += operations
+            self._counts[(str(account), phase)][kind] += operations
+            return True
+
+    def estimate_run(self, accounts: int, mcc_accounts: int = 0, max_rows: int = 0, mutate_passes: int = 0) -> int:
+        """Estimates the operations of a run once its accounts are sized: the operations used so far,
+        one keyword index query per MCC account, and search term, keyword and campaign negative queries
+        per scheduled account. Every search term row adds at most one prominent lookup, and one mutate
+        operation per upload or dry run pass, so with max_rows an upper bound of the search term rows,
+        the estimate is an upper bound of the run."""
+        with self._lock:
+            used = self._used
+        self.estimate = used + mcc_accounts + accounts * 3 + max_rows * (1 + mutate_passes)
+        logging.info(f"Estimated at most {self.estimate} operations, {max_rows * (1 + mutate_passes)} of them "
+                     f"prominent lookups and mutates{f', budget {self.budget} ({self.mode})' if self.budget else ''}.")
+        if self.budget and self.estimate > self.budget:
+            logging.warning(f"Estimated operations exceed the run budget of {self.budget}.")
+        return self.estimate
+
+    def usage(self) -> List[Dict[str, Any]]:
+        """Returns one entry per account and phase, in the order they were first charged."""
+        with self._lock:
+            return [{'account': account, 'phase': phase, SEARCH: counts[SEARCH], MUTATE: counts[MUTATE]}
+                    for (account, phase), counts in self._counts.items()]
+
+    def skipped(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._skipped)
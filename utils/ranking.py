@@ -0,0 +1,79 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+from typing import Any, Dict, Iterator, List, Tuple
+
+RANK_METRICS = ('cost', 'clicks', 'conversions', 'composite')
+RANK_GROUPS = ('account', 'campaign')
+# Composite score weights, roughly one conversion ~ 20 clicks ~ the cost of 20 clicks
+_COMPOSITE_WEIGHTS = {'cost': 1.0, 'clicks': 1.0, 'conversions': 20.0}
+_CUT_METRICS = ('clicks', 'impressions', 'conversions', 'cost')
+
+
+class TopKRanker:
+    """Keeps the K highest scoring rows per account or campaign with one min-heap per group,
+    so memory is O(K) per group however many rows are added. Totals of the rows that
+    were cut are kept per group."""
+
+    def __init__(self, k: int, metric: str = 'cost', group_by: str = 'account'):
+        if k < 1:
+            raise ValueError("K must be a positive number of rows.")
+        if metric not in RANK_METRICS:
+            raise ValueError(f"Rank metric must be one of {', '.join(RANK_METRICS)}.")
+        if group_by not in RANK_GROUPS:
+            raise ValueError(f"Rank group must be one of {', '.join(RANK_GROUPS)}.")
+        self._k = k
+        self._metric = metric
+        self.group_by = group_by
+        self._heaps = {}
+        self._cut = {}
+        # Breaks score ties without comparing rows
+        self._sequence = itertools.count()
+
+    def score(self, stats: Dict[str, Any]) -> float:
+        if self._metric == 'composite':
+            return sum(weight * stats[metric] for metric, weight in _COMPOSITE_WEIGHTS.items())
+        return stats[self._metric]
+
+    def add(self, row: List[Any], stats: Dict[str, Any]):
+        group = (stats['account_id'], stats['campaign_id'] if self.group_by == 'campaign' else None)
+        heap = self._heaps.setdefault(group, [])
+        entry = (self.score(stats), next(self._sequence), row, stats)
+        if len(heap) < self._k:
+            heapq.heappush(heap, entry)
+            return
+        _, _, _, cut_stats = heapq.heappushpop(heap, entry)
+        self._add_cut(group, cut_stats)
+
+    def _add_cut(self, group, stats):
+        cut = self._cut.get(group)
+        if cut is None:
+            cut = self._cut[group] = {'rows': 0, 'stats': stats}
+            cut.update({metric: 0 for metric in _CUT_METRICS})
+        cut['rows'] += 1
+        for metric in _CUT_METRICS:
+            cut[metric] += stats[metric]
+
+    def rows(self) -> Iterator[List[Any]]:
+        """Kept rows of each group, highest score first."""
+        for heap in self._heaps.values():
+            for _, _, row, _ in sorted(heap, reverse=True):
+                yield row
+
+    def cut(self) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Yields (stats of a cut row, totals) per group that had rows cut."""
+        for cut in self._cut.values():
+            yield cut['stats'], cut
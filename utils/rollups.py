@@ -0,0 +1,68 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Per account, campaign and ad group totals of the keyword and exclusion
+# recommendations of an account, so analysts don't have to pivot the detail sheets.
+
+from typing import Any, Dict, List
+
+ROLLUP_LEVELS = ('account', 'campaign', 'ad_group')
+ROLLUP_METRICS = ('clicks', 'impressions', 'cost', 'conversions')
+# Identity columns of each level, keys of SearchTermBuilder stats
+_LEVEL_COLUMNS = {
+    'account': ('account', 'account_id'),
+    'campaign': ('account', 'account_id', 'campaign', 'campaign_id'),
+    'ad_group': ('account', 'account_id', 'campaign', 'campaign_id', 'ad_group', 'ad_group_id'),
+}
+_WIDTH = 1 + len(ROLLUP_METRICS)
+
+
+def summarize(keywords: Dict[str, Dict[Any, Any]], exclusions: Dict[str, Dict[Any, Any]]) -> Dict[str, List[List[Any]]]:
+    """Returns rows per level of ROLLUP_LEVELS: the level's identity columns, then the count and
+    ROLLUP_METRICS totals of keywords, then of exclusions. Highest total cost first.
+
+    Ad group totals are summed in a single pass over the recommendations, campaign and
+    account totals are summed from the ad group totals."""
+    ad_groups = {}
+    for offset, recommendations in ((0, keywords), (_WIDTH, exclusions)):
+        for data in recommendations.values():
+            for ag_id, stats in data.items():
+                if ag_id == 'prominent':
+                    continue
+                entry = ad_groups.get(ag_id)
+                if entry is None:
+                    entry = ad_groups[ag_id] = (stats, [0] * (2 * _WIDTH))
+                totals = entry[1]
+                totals[offset] += 1
+                for i, metric in enumerate(ROLLUP_METRICS, offset + 1):
+                    totals[i] += stats[metric]
+    if not ad_groups:
+        return {}
+
+    rows = {}
+    cost = ROLLUP_METRICS.index('cost') + 1
+    for level in ROLLUP_LEVELS:
+        level_totals = {}
+        for stats, totals in ad_groups.values():
+            key = tuple(stats[column] for column in _LEVEL_COLUMNS[level])
+            current = level_totals.get(key)
+            if current is None:
+                level_totals[key] = list(totals)
+            else:
+                for i, value in enumerate(totals):
+                    current[i] += value
+        ordered = sorted(level_totals.items(), key=lambda item: item[1][cost] + item[1][_WIDTH + cost], reverse=True)
+        rows[level] = [list(key) + [round(value, 2) for value in totals] for key, totals in ordered]
+
+    return rows
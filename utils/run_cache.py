@@ -0,0 +1,109 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable
+from utils.entities import RunSettings
+
+_DEFAULT_TTL_SECONDS = 15 * 60
+# Full MCC results can be large, keep only the most recently used ones
+_DEFAULT_MAX_ENTRIES = 8
+
+
+def run_key(mcc_id: str, run_settings: RunSettings, keep_negatives: bool = False) -> str:
+    """Hashes the normalized run settings and account list of a run."""
+    normalized = {
+        'mcc_id': str(mcc_id),
+        'thresholds': {k: float(v) for k, v in run_settings.thresholds.items()},
+        'start_date': run_settings.start_date,
+        'end_date': run_settings.end_date,
+        'accounts': sorted(str(a) for a in run_settings.accounts),
+        'mcc_wide_dedup': run_settings.mcc_wide_dedup,
+        'ngram_analysis': run_settings.ngram_analysis,
+        # Results hold the ranked rows, and the full exclusions only when kept to upload or validate
+        'top_k': run_settings.top_k,
+        'rank_metric': run_settings.rank_metric,
+        'rank_by': run_settings.rank_by,
+        'keep_negatives': keep_negatives,
+        # A budgeted run can leave out accounts and prominent lookups
+        'quota_budget': run_settings.quota_budget,
+        'quota_mode': run_settings.quota_mode,
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class RunCache:
+    """Single-flight result cache for runs.
+
+    Identical requests made while a run is in flight wait for that run instead
+    of starting their own, and completed results are served until the TTL expires.
+    At most max_entries results are kept, the least recently used is evicted first.
+    Results are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, ttl_seconds: float = _DEFAULT_TTL_SECONDS, max_entries: int = _DEFAULT_MAX_ENTRIES):
+        self._ttl = ttl_seconds
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._in_flight = {}
+
+    def get_or_run(self, key: str, run: Callable[[], Any]) -> Any:
+        with self._lock:
+            self._evict_expired()
+            if key in self._results:
+                self._results.move_to_end(key)
+                logging.info(f'Serving cached results for run {key[:12]}')
+                return self._results[key][1]
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            logging.info(f'Attaching to in-flight run {key[:12]}')
+            return future.result()
+
+        try:
+            result = run()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._evict_expired()
+            self._results[key] = (time.monotonic() + self._ttl, result)
+            while len(self._results) > self._max_entries:
+                self._results.popitem(last=False)
+            self._in_flight.pop(key)
+        future.set_result(result)
+        return result
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._results.pop(key, None)
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._results.items() if expires_at <= now]:
+            self._results.pop(key)
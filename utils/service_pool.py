@@ -0,0 +1,101 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Process-wide pool of Google Ads clients, service clients and message types.
+# Every client.get_service() call opens a new gRPC channel, so builders and
+# mutators take their services from here instead of creating their own.
+
+import itertools
+import os
+import threading
+import weakref
+from typing import Any, Dict
+import google.ads.googleads.client as ads_client_module
+from google.ads.googleads.client import GoogleAdsClient
+
+_DEFAULT_CHANNELS_PER_SERVICE = int(os.getenv('ads_channels_per_service', 2))
+_DEFAULT_KEEPALIVE_MS = int(os.getenv('ads_keepalive_ms', 30000))
+_KEEPALIVE_OPTIONS = ('grpc.keepalive_time_ms', 'grpc.keepalive_timeout_ms',
+                      'grpc.keepalive_permit_without_calls', 'grpc.http2.max_pings_without_data')
+
+
+class ServicePool:
+    def __init__(self, channels_per_service=_DEFAULT_CHANNELS_PER_SERVICE, keepalive_ms=_DEFAULT_KEEPALIVE_MS):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._services = weakref.WeakKeyDictionary()
+        self._types = {}
+        self.configure(channels_per_service, keepalive_ms)
+
+    def configure(self, channels_per_service=None, keepalive_ms=None):
+        """Sets the number of channels opened per service and client, and gRPC keep-alive.
+
+        Only affects channels opened after the call.
+        """
+        if channels_per_service is not None:
+            if channels_per_service < 1:
+                raise ValueError("At least one channel per service is required.")
+            self._channels_per_service = channels_per_service
+        if keepalive_ms is not None:
+            _set_keepalive(keepalive_ms)
+
+    def get_client(self, config: Dict[str, Any]) -> GoogleAdsClient:
+        """Returns one GoogleAdsClient per set of credentials for the life of the process."""
+        key = tuple(sorted((k, str(v)) for k, v in config.items()))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = GoogleAdsClient.load_from_dict(config)
+                self._clients[key] = client
+            return client
+
+    def get_service(self, client: GoogleAdsClient, name: str):
+        """Returns a service client of `client`, spreading callers over a fixed set of channels."""
+        with self._lock:
+            services = self._services.setdefault(client, {})
+            entry = services.get(name)
+            if entry is None:
+                instances = [client.get_service(name) for _ in range(self._channels_per_service)]
+                entry = (instances, itertools.cycle(instances))
+                services[name] = entry
+            return next(entry[1])
+
+    def get_type_class(self, client: GoogleAdsClient, name: str):
+        key = (client.version, client.use_proto_plus, name)
+        with self._lock:
+            message_class = self._types.get(key)
+            if message_class is None:
+                message_class = type(client.get_type(name))
+                self._types[key] = message_class
+            return message_class
+
+    def get_type(self, client: GoogleAdsClient, name: str):
+        """Returns a new message of type `name`, resolving the message class only once."""
+        return self.get_type_class(client, name)()
+
+
+def _set_keepalive(keepalive_ms):
+    # The client library builds every channel from this module level option list
+    # and has no per-call hook for channel options.
+    options = [option for option in ads_client_module._GRPC_CHANNEL_OPTIONS
+               if option[0] not in _KEEPALIVE_OPTIONS]
+    if keepalive_ms > 0:
+        options += [('grpc.keepalive_time_ms', keepalive_ms),
+                    ('grpc.keepalive_timeout_ms', min(keepalive_ms, 20000)),
+                    ('grpc.keepalive_permit_without_calls', 1),
+                    ('grpc.http2.max_pings_without_data', 0)]
+    ads_client_module._GRPC_CHANNEL_OPTIONS[:] = options
+
+
+pool = ServicePool()
@@ -14,12 +14,14 @@
 
 import re
 import logging
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Optional
 from datetime import datetime
 from google.oauth2.credentials import Credentials
 from utils.auth import CONFIG_FILE, SCOPES
+from utils.ranking import TopKRanker
+from utils.rollups import ROLLUP_METRICS
+from utils import metrics
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 _SHEETS_SERVICE_VERSION = 'v4'
@@ -27,11 +29,28 @@ _SHEETS_SERVICE_NAME = 'sheets'
 
 _HEADER = ['keyword', 'account name', 'account id', 'campaign name',
            'campaign id', 'adgroup name', 'adgroup id','prominent adgroup', 'clicks', 'impressions', 'conversions', 'cost', 'ctr']
+_DRY_RUN_SUMMARY_HEADER = ['account id', 'operations', 'failed operations', 'skipped operations', 'requests',
+                           'estimated upload seconds', 'estimated operations cost']
+_NGRAMS_HEADER = ['account id', 'ngram', 'n', 'search terms', 'clicks', 'impressions', 'cost',
+                  'conversions', 'cost per conversion']
+_DRY_RUN_ERRORS_HEADER = ['account id', 'keyword', 'adgroup id', 'error code', 'error message']
+_QUOTA_HEADER = ['account id', 'phase', 'search operations', 'mutate operations']
+_ROLLUP_TOTALS_HEADER = (['keywords'] + [f'keyword {metric}' for metric in ROLLUP_METRICS]
+                         + ['exclusions'] + [f'exclusion {metric}' for metric in ROLLUP_METRICS])
+_ROLLUP_HEADERS = {
+    'account': ['account name', 'account id'] + _ROLLUP_TOTALS_HEADER,
+    'campaign': ['account name', 'account id', 'campaign name', 'campaign id'] + _ROLLUP_TOTALS_HEADER,
+    'ad_group': ['account name', 'account id', 'campaign name', 'campaign id',
+                 'adgroup name', 'adgroup id'] + _ROLLUP_TOTALS_HEADER,
+}
 _RUN_DATETIME = datetime.now()
 _RUN_METADATA = f'Last run was completed on {_RUN_DATETIME}'
 _KEYWORDS_SHEET = 'Keywords'
 _EXCLUSIONS_SHEET = 'Exclusions'
 _SS_NAME = 'SeaTerA'
+_DELTA_SHEETS = (_KEYWORDS_SHEET, _EXCLUSIONS_SHEET)
+# keyword, account id, campaign id and adgroup id columns of _HEADER
+_ROW_KEY_COLUMNS = (0, 2, 4, 6)
 
 class SheetsInteractor:
     def __init__(self, service, spreadsheet_url):
@@ -54,22 +73,40 @@ class SheetsInteractor:
         spreadsheet_id = spreadsheet_match.group(1)
         return spreadsheet_id
 
-    def write_to_spreadsheet(self, ouput: Dict[str, Dict[Any, Any]]):
+    def write_to_spreadsheet(self, ouput: Dict[str, Dict[Any, Any]], delta: bool = False):
+        """Writes each sheet in full. With delta, the Keywords and Exclusions sheets only get
+        their changed, new and removed rows written, when the previous run's rows can be read.
+        Removed rows are only deleted once the values were written."""
+        self._ensure_sheets(ouput.keys())
         data = []
+        removed_rows = {}
         for sheet, values in ouput.items():
+            if delta and sheet in _DELTA_SHEETS:
+                sheet_delta = self._get_delta(sheet, values)
+                if sheet_delta is not None:
+                    data.extend(sheet_delta[0])
+                    removed_rows[sheet] = sheet_delta[1]
+                    continue
             self._clear_sheet(sheet)
-            range = sheet + '!A1:' + \
-                chr(len(values[0]) + 65) + str(len(values))
+            width = max(len(row) for row in values)
+            range = f"'{sheet}'!A1:" + \
+                chr(width + 65) + str(len(values))
             data.append({'range': range, 'values': values})
 
-        body = {'data': data, 'valueInputOption': "USER_ENTERED"}
+        # RAW keeps search terms like "march 3" or "+ shoes" as text, so they read back
+        # unchanged and delta row keys match on the next run
+        body = {'data': data, 'valueInputOption': "RAW"}
         try:
-            result = self.service.values().batchUpdate(
-                spreadsheetId=self.spreadsheet_id, body=body).execute()
+            with metrics.SHEETS_WRITE_SECONDS.time():
+                result = self.service.values().batchUpdate(
+                    spreadsheetId=self.spreadsheet_id, body=body).execute()
             logging.info(
-                f"{(result.get('totalUpdatedRows') -4)} Rows updated.")
+                f"{result.get('totalUpdatedRows')} Rows updated.")
+            for sheet, row_numbers in removed_rows.items():
+                self._delete_rows(sheet, row_numbers)
             return result
         except HttpError as e:
+            metrics.API_ERRORS.inc(call='sheets_write')
             logging.exception(e)
             return e
 
@@ -81,10 +118,104 @@ class SheetsInteractor:
 
     def _clear_sheet(self, sheet_name):
         """Helper function to clear output sheet before writing to it."""
-        range_name = sheet_name + '!A:Z'
+        range_name = f"'{sheet_name}'!A:Z"
         self.service.values().clear(
             spreadsheetId=self.spreadsheet_id, range=range_name, body={}).execute()
 
+    def _ensure_sheets(self, sheet_names):
+        """Adds any output sheet that is missing from spreadsheets created by older versions."""
+        spreadsheet = self.service.get(
+            spreadsheetId=self.spreadsheet_id, fields='sheets.properties(title,sheetId)').execute()
+        self._sheet_ids = {sheet['properties']['title']: sheet['properties']['sheetId']
+                           for sheet in spreadsheet.get('sheets', [])}
+        requests = [{'addSheet': {'properties': {'title': name}}}
+                    for name in sheet_names if name not in self._sheet_ids]
+        if requests:
+            response = self.service.batchUpdate(
+                spreadsheetId=self.spreadsheet_id, body={'requests': requests}).execute()
+            for reply in response.get('replies', []):
+                properties = reply['addSheet']['properties']
+                self._sheet_ids[properties['title']] = properties['sheetId']
+
+    def _get_delta(self, sheet, values):
+        """Diffs `values` against the rows currently in the sheet by row key. Returns the value
+        ranges to write for the metadata row, changed rows in place and new rows appended at
+        the end, and the row numbers of removed rows, to delete after the write. Row numbers are
+        those of the sheet before any delete. Returns None when the sheet has to be fully rewritten."""
+        existing = self.service.values().get(
+            spreadsheetId=self.spreadsheet_id, range=f"'{sheet}'!A:Z",
+            valueRenderOption='UNFORMATTED_VALUE').execute().get('values', [])
+        if len(existing) < 2 or _normalize_row(existing[1]) != _normalize_row(values[1]):
+            return None
+
+        # Row key index of the previous run, mapped to sheet row numbers
+        index = {}
+        for row_number, row in enumerate(existing[2:], start=3):
+            index[_row_key(row)] = (row_number, _normalize_row(row))
+        if len(index) != len(existing) - 2:
+            return None
+
+        changed, new = [], []
+        for row in values[2:]:
+            key = _row_key(row)
+            previous = index.pop(key, None)
+            if previous is None:
+                new.append(row)
+            elif previous[1] != _normalize_row(row):
+                changed.append((previous[0], row))
+        removed = sorted(row_number for row_number, _ in index.values())
+
+        data = [{'range': f"'{sheet}'!A1", 'values': [values[0]]}]
+        for row_number, rows in _consecutive_runs(changed):
+            data.append({'range': f"'{sheet}'!A{row_number}", 'values': rows})
+        if new:
+            data.append({'range': f"'{sheet}'!A{len(existing) + 1}", 'values': new})
+
+        logging.info(f"Delta write to {sheet}: {len(changed)} changed, {len(new)} new, {len(removed)} removed rows.")
+        return data, removed
+
+    def _delete_rows(self, sheet, row_numbers):
+        """Deletes sheet rows with one batched request, bottom up so row numbers stay valid."""
+        if not row_numbers:
+            return
+        requests = []
+        for start, rows in reversed(_consecutive_runs([(n, n) for n in row_numbers])):
+            requests.append({'deleteDimension': {'range': {
+                'sheetId': self._sheet_ids[sheet], 'dimension': 'ROWS',
+                'startIndex': start - 1, 'endIndex': start - 1 + len(rows)}}})
+        self.service.batchUpdate(
+            spreadsheetId=self.spreadsheet_id, body={'requests': requests}).execute()
+
+
+def _normalize_cell(value):
+    # Sheets returns whole numbers without a decimal part
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _normalize_row(row):
+    row = [_normalize_cell(value) for value in row]
+    # Sheets drops trailing empty cells
+    while row and row[-1] == '':
+        row.pop()
+    return row
+
+
+def _row_key(row):
+    return tuple(_normalize_cell(row[i]) if i < len(row) else '' for i in _ROW_KEY_COLUMNS)
+
+
+def _consecutive_runs(numbered_rows):
+    """Groups (row number, row) pairs into (first row number, rows) runs of consecutive rows."""
+    runs = []
+    for row_number, row in sorted(numbered_rows, key=lambda item: item[0]):
+        if runs and runs[-1][0] + len(runs[-1][1]) == row_number:
+            runs[-1][1].append(row)
+        else:
+            runs.append((row_number, [row]))
+    return runs
+
 
 def get_sheets_service(config: Dict[str, Any]):
     creds = None
@@ -99,8 +230,12 @@ def get_sheets_service(config: Dict[str, Any]):
     if creds.expired:
         creds.refresh(Request())
 
+    # Imported here to keep it off the container's cold start path
+    from googleapiclient.discovery import build
+    # Use the discovery document bundled with the library instead of fetching it
     service = build(_SHEETS_SERVICE_NAME,
-                    _SHEETS_SERVICE_VERSION, credentials=creds)
+                    _SHEETS_SERVICE_VERSION, credentials=creds,
+                    static_discovery=True, cache_discovery=False)
     return service
 
 
@@ -128,19 +263,106 @@ def create_new_spreadsheet(sheet_service):
     return ss.get('spreadsheetUrl')
 
 
-def flatten_data(dict: Dict[str, Any]) -> List[List[Any]]:
+def recommendation_rows(recommendations: Dict[str, Any], ranker: Optional[TopKRanker] = None) -> List[List[Any]]:
+    """Lays out the keyword or exclusion recommendations of one account as _HEADER rows. With a ranker,
+    only its top K rows per group are kept, followed by an aggregate row per group recording what was cut."""
+    results = []
+    for kw, data in recommendations.items():
+        prominent = data.get('prominent', '')
+        for key, stats in data.items():
+            if key != 'prominent':
+                row = [kw, stats['account'], stats['account_id'], stats['campaign'], stats['campaign_id'], stats['ad_group'], stats['ad_group_id'],
+                    prominent, stats['clicks'], stats['impressions'], stats['conversions'], stats['cost'], stats['ctr']]
+                if ranker:
+                    ranker.add(row, stats)
+                else:
+                    results.append(row)
+
+    if ranker:
+        results.extend(ranker.rows())
+        for stats, cut in ranker.cut():
+            campaign, campaign_id = (stats['campaign'], stats['campaign_id']) if ranker.group_by == 'campaign' else ('', '')
+            results.append([f"({cut['rows']} more rows not shown)", stats['account'], stats['account_id'], campaign, campaign_id,
+                            '', '', '', cut['clicks'], cut['impressions'], cut['conversions'], round(cut['cost'], 2), ''])
+
+    return results
+
+
+def flatten_data(rows: Dict[str, List[List[Any]]]) -> List[List[Any]]:
+    """Lays out recommendation_rows of every account."""
     row_len = len(_HEADER)
     metadata_row = ['' for i in range(row_len)]
     metadata_row[0] = _RUN_METADATA
     results = [metadata_row, _HEADER]
 
-    for v in dict.values():
-        for kw, data in v.items():
-            prominent = data.get('prominent', '')
-            for key, stats in data.items():
-                if key != 'prominent':
-                    row = [kw, stats['account'], stats['account_id'], stats['campaign'], stats['campaign_id'], stats['ad_group'], stats['ad_group_id'],
-                        prominent, stats['clicks'], stats['impressions'], stats['conversions'], stats['cost'], stats['ctr']]
-                    results.append(row)
+    for account_rows in rows.values():
+        results.extend(account_rows)
+
+    return results
+
+
+def flatten_dry_run(reports: List[Any]) -> List[List[Any]]:
+    """Lays out dry run reports as a per-account summary followed by per-operation errors."""
+    metadata_row = ['' for i in range(len(_DRY_RUN_SUMMARY_HEADER))]
+    metadata_row[0] = f'Dry run was completed on {_RUN_DATETIME}. No operations were applied.'
+    results = [metadata_row, _DRY_RUN_SUMMARY_HEADER]
+
+    for report in reports:
+        results.append([report.customer_id, report.total_operations, report.failed_operations,
+                        report.skipped_operations, report.requests, round(report.estimated_seconds, 1), report.estimated_operations_cost])
+
+    results.append([])
+    results.append(_DRY_RUN_ERRORS_HEADER)
+    for report in reports:
+        for kw, ag_id, code, message in report.errors:
+            results.append([report.customer_id, kw, ag_id, code, message])
+
+    return results
+
+
+def flatten_ngrams(ngrams: Dict[str, List[List[Any]]]) -> List[List[Any]]:
+    """Lays out mine_ngrams rows of every account, most wasteful first within each account."""
+    metadata_row = ['' for i in range(len(_NGRAMS_HEADER))]
+    metadata_row[0] = _RUN_METADATA
+    results = [metadata_row, _NGRAMS_HEADER]
+
+    for account, rows in ngrams.items():
+        for row in rows:
+            results.append([account] + row)
+
+    return results
+
+
+def flatten_rollups(rollups: Dict[str, Dict[str, List[List[Any]]]], level: str) -> List[List[Any]]:
+    """Lays out summarize rows of one level for every account."""
+    header = _ROLLUP_HEADERS[level]
+    metadata_row = ['' for i in range(len(header))]
+    metadata_row[0] = _RUN_METADATA
+    results = [metadata_row, header]
+
+    for account_rollups in rollups.values():
+        results.extend(account_rollups[level])
+
+    return results
+
+
+def flatten_quota_usage(accountant: Any) -> List[List[Any]]:
+    """Lays out an OperationAccountant's budget, estimate and totals followed by usage per account and phase."""
+    metadata_row = ['' for i in range(len(_QUOTA_HEADER))]
+    metadata_row[0] = _RUN_METADATA
+    usage = accountant.usage()
+    skipped = accountant.skipped()
+    results = [metadata_row,
+               ['budget', accountant.budget or 'none', 'mode', accountant.mode],
+               ['estimated operations (at most)', accountant.estimate if accountant.estimate is not None else '',
+                'used operations', accountant.used],
+               ['skipped operations', sum(skipped.values()),
+                'skipped phases', ', '.join(f'{phase} ({count})' for phase, count in skipped.items())],
+               [],
+               _QUOTA_HEADER]
+
+    for entry in usage:
+        results.append([entry['account'], entry['phase'], entry['search'], entry['mutate']])
+    results.append(['total', '', sum(e['search'] for e in usage), sum(e['mutate'] for e in usage)])
 
     return results